@@ -1,46 +1,233 @@
 import asyncio
+import contextvars
+import json
 import os
-import random
 import time
-import re
 import logging
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
 
 import undetected_chromedriver as uc
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
+
+from ApexHttpReader import ApexHttpReader
+from ApexPageParser import parse_panel_page
+from BrowserPool import BrowserPool
+from LogTailer import LogTailer
+from Metrics import Histogram
+from Resilience import BackendError, CircuitBreaker
+from StatusCache import StatusCache
+from StatusWaiter import TransitionStats, wait_for_status
 
 load_dotenv()
 
+USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_1) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/80.0.3987.163 Safari/537.36"
+)
+OPERATION_SECONDS = Histogram(
+    "apex_operation_seconds",
+    "Apex panel operation time, including time queued for the browser",
+    ["operation"],
+)
+PAGE_SECONDS = Histogram("apex_page_load_seconds", "Apex panel page load time", ["page"])
+
+# The browser checked out for the operation running in this task.
+current_browser = contextvars.ContextVar("current_browser")
+
+# The status icon is filled in by an AJAX call after the page itself has loaded.
+STATUS_ICON_LOADED_SCRIPT = """
+var icon = document.querySelector('#statusicon-ajax img');
+var idle = typeof jQuery === 'undefined' || jQuery.active === 0;
+return document.readyState === 'complete' && idle && icon !== null
+    && !!icon.getAttribute('src');
+"""
+
+
+def status_icon_loaded(driver):
+    return driver.execute_script(STATUS_ICON_LOADED_SCRIPT)
+
+
+def login_form_loaded(driver):
+    return bool(
+        driver.find_elements(By.ID, "LoginForm_name")
+        or driver.find_elements(By.ID, "logout_link")
+    )
+
+
+def login_finished(driver):
+    return bool(
+        driver.find_elements(By.ID, "logout_link")
+        or driver.find_elements(By.CLASS_NAME, "errorMessage")
+    )
+
+
+def is_logged_out(driver):
+    return bool(
+        driver.find_elements(By.ID, "LoginForm_name")
+        or not driver.find_elements(By.ID, "logout_link")
+    )
+
+
+def set_cookies(driver, cookies):
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+
+
+def get_page_source(driver):
+    return driver.page_source
+
+
+def click_button(driver, name, error_message):
+    button = driver.find_element("name", name)
+    if button.get_attribute('disabled') is not None:
+        # The panel refusing the action, e.g. starting a running server, is not an outage.
+        raise BackendError(error_message, retryable=False)
+    button.click()
+
+
+def send_console_command(driver, command):
+    driver.find_element("id", "command").send_keys(command)
+    click_button(driver, "yt4", "Failed to send command to server.")
+
+
+def submit_login(driver, username, password):
+    driver.find_element("id", "LoginForm_name").send_keys(username)
+    driver.find_element("id", "LoginForm_password").send_keys(password)
+    driver.find_element("name", "yt0").click()
+
 
 class ApexHostingApi:
     APH_USERNAME = os.getenv("APH_USERNAME")
     APH_PASSWORD = os.getenv("APH_PASSWORD")
-    ApexHostingPanelLoginURL = "https://panel.apexminecrafthosting.com/"
-    ApexHostingPanelServerDashboardURL = "https://panel.apexminecrafthosting.com/server/"
+    ApexHostingPanelLoginURL = os.getenv(
+        "APH_PANEL_URL", "https://panel.apexminecrafthosting.com/"
+    )
+    ApexHostingPanelServerDashboardURL = ApexHostingPanelLoginURL + "server/"
     ServerID = None
+    TransitionalStatuses = {"starting", "stopping", "restarting"}
+    SessionFile = os.getenv("APH_SESSION_FILE", "apex_session.json")
 
-    def __init__(self, headless=True, min_timeout=5, max_timeout=10):
+    def __init__(
+        self,
+        headless=True,
+        min_timeout=5,
+        max_timeout=10,
+        username=None,
+        password=None,
+        session_file=None,
+    ):
+        self.APH_USERNAME = username or self.APH_USERNAME
+        self.APH_PASSWORD = password or self.APH_PASSWORD
+        self.SessionFile = session_file or self.SessionFile
         options = uc.ChromeOptions()
-        options.add_argument(
-            "user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_1) AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/80.0.3987.163 Safari/537.36")
+        options.add_argument("user-agent=" + USER_AGENT)
         options.add_argument('--disable-dev-shm-usage')
         if headless:
             options.add_argument('--headless')
-        self.driver = uc.Chrome(options=options)
+        self.http_reader = ApexHttpReader(USER_AGENT)
+        self.cookies = None
+        self.cookie_generation = 0
+        self.browser_pool = BrowserPool(
+            lambda: uc.Chrome(options=options),
+            size=int(os.getenv("APH_BROWSER_POOL_SIZE", 2)),
+            max_uses=int(os.getenv("APH_BROWSER_MAX_USES", 50)),
+            max_rss_mb=int(os.getenv("APH_BROWSER_MAX_RSS_MB", 1024)),
+            warm=self.prepare_browser,
+            name=f"apex-{self.APH_USERNAME}",
+            retire_on=(WebDriverException,),
+            checkout_timeout=float(os.getenv("APH_BROWSER_CHECKOUT_TIMEOUT", 120)),
+        )
         self.min_timeout = min_timeout
         self.max_timeout = max_timeout
+        self.poll_interval = 0.25
+        self.page_timings = defaultdict(lambda: deque(maxlen=50))
+        self.circuit_breaker = CircuitBreaker(
+            f"apex:{self.APH_USERNAME}", failure_errors=(WebDriverException,)
+        )
+        self.status_cache = StatusCache(ttl=float(os.getenv("STATUS_CACHE_TTL", 5)))
+        self.transitional_statuses = self.TransitionalStatuses
+        self.action_targets = {
+            "start": ["online"],
+            "stop": ["offline"],
+            "restart": ["online"],
+        }
+        self.transition_stats = TransitionStats()
+        self.log_tailer = LogTailer(
+            self.fetch_console_log, max_lines=int(os.getenv("LOG_BUFFER_LINES", 500))
+        )
+        self.restore_session()
+        self.browser_pool.start()
+
+    @property
+    def browser(self):
+        return current_browser.get()
+
+    async def close(self):
+        await self.browser_pool.close()
+        await self.http_reader.close()
 
     async def get_server_status(self):
+        return await self.status_cache.get(self.fetch_server_status)
+
+    async def wait_for_status(
+        self, targets, timeout=600, on_progress=None, require_change=False
+    ):
+        result = await wait_for_status(
+            self.fetch_server_status,
+            targets,
+            timeout=timeout,
+            on_progress=on_progress,
+            require_change=require_change,
+        )
+        self.status_cache.invalidate()
+        return result
+
+    @asynccontextmanager
+    async def queued(self, name):
+        # Each operation spans several page loads and clicks, so it keeps one browser
+        # from the pool to itself until it is done.
+        with OPERATION_SECONDS.time(operation=name):
+            async with self.browser_pool.checkout() as browser:
+                await self.prepare_browser(browser)
+                token = current_browser.set(browser)
+                try:
+                    yield
+                finally:
+                    current_browser.reset(token)
+
+    async def prepare_browser(self, browser):
+        # Browsers warmed before the latest login still carry the old cookies.
+        if self.cookies and browser.cookie_generation != self.cookie_generation:
+            await browser.call(set_cookies, self.cookies)
+            browser.cookie_generation = self.cookie_generation
+
+    async def read_status(self):
+        # Reads go over plain HTTP with the browser's cookies when possible.
+        if self.ServerID is None:
+            return None
+        return await self.http_reader.fetch_status(self.get_server_dashboard_url())
+
+    async def read_log(self, log_seq=None):
+        if self.ServerID is None:
+            return None
+        return await self.http_reader.fetch_log(self.get_server_console_url(), log_seq)
+
+    async def fetch_server_status(self):
+        status = await self.read_status()
+        if status is not None:
+            logging.debug(f"Server Status: {status}")
+            return status
+        async with self.queued("get_server_status"):
+            return await self.read_server_status()
+
+    async def read_server_status(self):
         try:
             logging.debug("Getting Server Status")
-            soup = await self.go_to_console()
-            status_icon_div = soup.find('div', id='statusicon-ajax')
-            img_source = status_icon_div.img.attrs['src']
-            status = img_source.split("/")[-1].split(".png")[0]
+            snapshot = await self.go_to_console()
+            status = snapshot.status
             logging.debug(f"Server Status: {status}")
             return status
         except Exception as err:
@@ -48,101 +235,182 @@ class ApexHostingApi:
             raise
 
     async def stop_server(self):
-        try:
-            logging.debug("Stopping Server")
-            await self.go_to_console()
-            button = self.driver.find_element("name", "yt1")
-            if button.get_attribute('disabled') is not None:
-                raise Exception("Failed to stop server.")
-            button.click()
-            logging.debug("Command sent!")
-        except Exception as err:
-            logging.error(err)
-            raise
+        async with self.queued("stop_server"):
+            try:
+                logging.debug("Stopping Server")
+                await self.go_to_console()
+                await self.browser.call(click_button, "yt1", "Failed to stop server.")
+                self.status_cache.invalidate()
+                logging.debug("Command sent!")
+            except Exception as err:
+                logging.error(err)
+                raise
 
     async def force_stop_server(self):
-        try:
-            logging.debug("Force stopping Server")
-            await self.go_to_console()
-            button = self.driver.find_element("name", "yt3")
-            if button.get_attribute('disabled') is not None:
-                raise Exception("Failed to force stop server.")
-            button.click()
-            logging.debug("Command sent!")
-        except Exception as err:
-            logging.error(err)
-            raise
+        async with self.queued("force_stop_server"):
+            try:
+                logging.debug("Force stopping Server")
+                await self.go_to_console()
+                await self.browser.call(click_button, "yt3", "Failed to force stop server.")
+                self.status_cache.invalidate()
+                logging.debug("Command sent!")
+            except Exception as err:
+                logging.error(err)
+                raise
 
     async def start_server(self):
-        try:
-            logging.debug("Starting Server")
-            await self.go_to_console()
-            button = self.driver.find_element("name", "yt0")
-            if button.get_attribute('disabled') is not None:
-                raise Exception("Failed to start server.")
-            button.click()
-            logging.debug("Command sent!")
-        except Exception as err:
-            logging.error(err)
-            raise
+        async with self.queued("start_server"):
+            try:
+                logging.debug("Starting Server")
+                await self.go_to_console()
+                await self.browser.call(click_button, "yt0", "Failed to start server.")
+                self.status_cache.invalidate()
+                logging.debug("Command sent!")
+            except Exception as err:
+                logging.error(err)
+                raise
 
     async def restart_server(self):
-        try:
-            logging.debug("Restarting Server")
-            await self.go_to_console()
-            button = self.driver.find_element("name", "yt2")
-            if button.get_attribute('disabled') is not None:
-                raise Exception("Failed to restart server.")
-            button.click()
-            logging.debug("Command sent!")
-        except Exception as err:
-            logging.error(err)
-            raise
+        async with self.queued("restart_server"):
+            try:
+                logging.debug("Restarting Server")
+                await self.go_to_console()
+                await self.browser.call(click_button, "yt2", "Failed to restart server.")
+                self.status_cache.invalidate()
+                logging.debug("Command sent!")
+            except Exception as err:
+                logging.error(err)
+                raise
+
+    async def safe_start_server(self):
+        # The panel disables the start button unless the server can be started.
+        return await self.start_server()
+
+    async def safe_stop_server(self):
+        return await self.stop_server()
+
+    async def broadcast(self, message):
+        return await self.run_console_command("say " + message)
+
+    async def wait_for(self, condition, timeout=None):
+        timeout = timeout or self.max_timeout
+        start = time.monotonic()
+        while True:
+            try:
+                if await self.browser.call(condition):
+                    return time.monotonic() - start
+            except WebDriverException:
+                pass
+            if time.monotonic() - start > timeout:
+                return None
+            await asyncio.sleep(self.poll_interval)
+
+    async def load_page(self, name, url, condition):
+        start = time.monotonic()
+        await self.browser.call(lambda driver: driver.get(url))
+        loaded = await self.wait_for(condition)
+        elapsed = time.monotonic() - start
+        self.page_timings[name].append(elapsed)
+        PAGE_SECONDS.observe(elapsed, page=name)
+        logging.debug(f"Loaded {name} page in {elapsed:.2f}s")
+        return loaded is not None
+
+    async def read_page(self):
+        # Parsed on the browser's thread, so the event loop never walks the HTML.
+        return await self.browser.call(
+            lambda driver: parse_panel_page(get_page_source(driver))
+        )
+
+    def get_page_timings(self):
+        return {
+            name: sum(timings) / len(timings)
+            for name, timings in self.page_timings.items()
+            if timings
+        }
 
     async def go_to_dashboard(self):
-        self.driver.get(self.get_server_dashboard_url())
-        await asyncio.sleep(self.get_timeout())
-        page_source = self.driver.page_source
-        soup = BeautifulSoup(page_source, features="html.parser")
-        if soup.find('div', id='statusicon-ajax') is None:
-            raise Exception("Server dashboard failed to load.")
-        return soup
+        await self.ensure_session()
+        loaded = await self.load_page(
+            "dashboard", self.get_server_dashboard_url(), status_icon_loaded
+        )
+        if not loaded and await self.browser.call(is_logged_out):
+            logging.debug("Panel session expired, logging in again")
+            await self.login()
+            await self.load_page(
+                "dashboard", self.get_server_dashboard_url(), status_icon_loaded
+            )
+        snapshot = await self.read_page()
+        if not snapshot.status_loaded:
+            raise BackendError("Server dashboard failed to load.")
+        return snapshot
 
     async def go_to_console(self):
-        self.driver.get(self.get_server_console_url())
-        await asyncio.sleep(self.get_timeout())
-        page_source = self.driver.page_source
-        soup = BeautifulSoup(page_source, features="html.parser")
-        if soup.find('div', id='statusicon-ajax') is None:
-            raise Exception("Server dashboard failed to load.")
-        return soup
+        await self.ensure_session()
+        loaded = await self.load_page(
+            "console", self.get_server_console_url(), status_icon_loaded
+        )
+        if not loaded and await self.browser.call(is_logged_out):
+            logging.debug("Panel session expired, logging in again")
+            await self.login()
+            await self.load_page(
+                "console", self.get_server_console_url(), status_icon_loaded
+            )
+        snapshot = await self.read_page()
+        if not snapshot.status_loaded:
+            raise BackendError("Server dashboard failed to load.")
+        return snapshot
 
     async def run_console_command(self, command):
-        try:
-            logging.debug("Running console command: ", command)
-            await self.go_to_console()
-            self.driver.find_element("id", "command").send_keys(command)
-            button = self.driver.find_element("name", "yt4")
-            if button.get_attribute('disabled') is not None:
-                raise Exception("Failed to send command to server.")
-            button.click()
-            logging.debug("Command sent!")
-        except Exception as err:
-            logging.error(err)
-            raise
+        async with self.queued("run_console_command"):
+            try:
+                logging.debug(f"Running console command: {command}")
+                await self.go_to_console()
+                await self.browser.call(send_console_command, command)
+                self.status_cache.invalidate()
+                logging.debug("Command sent!")
+            except Exception as err:
+                logging.error(err)
+                raise
 
-    async def get_console_log(self, lines=10):
-        try:
-            logging.debug("Getting console logs")
-            soup = await self.go_to_console()
-            console_log = soup.find('div', id='log-ajax')
-            log_entry_regex = "\d{2}.\d{2} \d{2}:\d{2}:\d{2}"
-            entries = re.sub(log_entry_regex, lambda x: '\n' + x.group(0), console_log.text)
-            entries = entries.split('\n')
-            return '\n'.join(list(filter(None, entries))[-lines:])
-        except Exception as err:
-            logging.error(err)
-            raise
+    async def run_console_script(self, steps):
+        results = []
+        for command, delay in steps:
+            try:
+                await self.run_console_command(command)
+            except Exception as err:
+                results.append((command, f"Error: {err}"))
+                break
+            results.append((command, None))
+            if delay:
+                await asyncio.sleep(delay)
+        return results
+
+    async def get_console_log(self, lines=10, search=None):
+        return '\n'.join(await self.log_tailer.get_lines(lines, search))
+
+    async def fetch_console_log(self, cursor):
+        # The cursor is the panel's log_seq and the last line seen.
+        log_seq, last_line = cursor or (None, None)
+        answer = await self.read_log(log_seq)
+        if answer is not None:
+            entries, next_seq = answer
+        else:
+            async with self.queued("get_console_log"):
+                try:
+                    logging.debug("Getting console logs")
+                    snapshot = await self.go_to_console()
+                    entries, next_seq = snapshot.log_entries or [], None
+                except Exception as err:
+                    logging.error(err)
+                    raise
+        # Without a log_seq the panel shows its whole window of the log, so continue
+        # after the last line seen.
+        if not (log_seq and next_seq) and last_line in entries:
+            last_seen = len(entries) - 1 - entries[::-1].index(last_line)
+            entries = entries[last_seen + 1:]
+        if entries:
+            last_line = entries[-1]
+        return entries, (next_seq, last_line)
 
     def get_server_dashboard_url(self):
         return self.ApexHostingPanelServerDashboardURL + self.ServerID
@@ -150,63 +418,93 @@ class ApexHostingApi:
     def get_server_console_url(self):
         return self.ApexHostingPanelServerDashboardURL + "log/" + self.ServerID
 
+    async def ensure_session(self):
+        if self.ServerID is None:
+            await self.login()
+
+    def use_cookies(self, cookies):
+        converted = []
+        for cookie in cookies:
+            cookie = dict(cookie)
+            if "expiry" in cookie:
+                cookie["expires"] = cookie.pop("expiry")
+            converted.append(cookie)
+        self.cookies = converted
+        self.cookie_generation += 1
+        self.http_reader.set_cookies(cookies)
+
+    async def save_session(self):
+        cookies = await self.browser.call(lambda driver: driver.get_cookies())
+        self.use_cookies(cookies)
+        self.browser.cookie_generation = self.cookie_generation
+        session = {"cookies": cookies, "server_id": self.ServerID}
+        try:
+            with open(self.SessionFile, "w") as session_file:
+                json.dump(session, session_file)
+        except OSError as err:
+            logging.error(f"Could not save panel session: {err}")
+
+    def restore_session(self):
+        if not os.path.exists(self.SessionFile):
+            return
+        try:
+            with open(self.SessionFile) as session_file:
+                session = json.load(session_file)
+            # Each pooled browser gets these through CDP, which avoids a page load
+            # just to get on the domain.
+            self.use_cookies(session["cookies"])
+            self.ServerID = session["server_id"]
+            logging.debug(f"Restored panel session for server {self.ServerID}")
+        except Exception as err:
+            logging.error(f"Could not restore panel session: {err}")
+
     async def login(self):
         try:
             logging.debug("Loading Login Page")
-            self.driver.get(self.ApexHostingPanelLoginURL)
-            element = None
-            try:
-                element = WebDriverWait(self.driver, self.get_timeout()).until(
-                    EC.presence_of_element_located((By.ID, 'LoginForm_name')))
-            except:
-                pass
-            if element is None:
-                page_source = self.driver.page_source
-                soup = BeautifulSoup(page_source, features="html.parser")
-                if soup.find('li', id='logout_link') is not None:
+            await self.load_page("login", self.ApexHostingPanelLoginURL, login_form_loaded)
+            login_form = await self.browser.call(
+                lambda driver: driver.find_elements(By.ID, "LoginForm_name")
+            )
+            if not login_form:
+                snapshot = await self.read_page()
+                if snapshot.logged_in:
                     # We are already logged in
                     logging.debug("Already Logged In! Skipping...")
-                    await self.get_server_id()
+                    await self.get_server_id(snapshot)
+                    await self.save_session()
                     return
                 else:
-                    raise Exception("Login Page Unable to load")
+                    raise BackendError("Login Page Unable to load")
             logging.debug("Login Page Loaded")
-            self.driver.find_element("id", "LoginForm_name").send_keys(self.APH_USERNAME)
-            self.driver.find_element("id", "LoginForm_password").send_keys(self.APH_PASSWORD)
-            self.driver.find_element("name", "yt0").click()
+            await self.browser.call(submit_login, self.APH_USERNAME, self.APH_PASSWORD)
             logging.debug("Trying login...")
-            await asyncio.sleep(self.get_timeout())
-            page_source = self.driver.page_source
-            soup = BeautifulSoup(page_source, features="html.parser")
-            soup.find('div', id='LoginForm_name')
-            if soup.find('div', class_='errorMessage') is not None:
-                raise Exception("Login Failed. Either Username/Password is incorrect")
-            if soup.find('li', id='logout_link') is None:
-                raise Exception("Login Failed. Api blocked by Url.")
+            await self.wait_for(login_finished)
+            snapshot = await self.read_page()
+            if snapshot.login_error:
+                raise BackendError(
+                    "Login Failed. Either Username/Password is incorrect",
+                    retryable=False,
+                )
+            if not snapshot.logged_in:
+                raise BackendError("Login Failed. Api blocked by Url.", retryable=False)
             logging.debug("Login Succeeded")
-            await self.get_server_id()
+            await self.get_server_id(snapshot)
+            await self.save_session()
         except Exception as err:
             logging.error(err)
             raise
 
-    async def get_server_id(self):
-        page_source = self.driver.page_source
-        soup = BeautifulSoup(page_source, features="html.parser")
-        server_index = soup.find('a', class_='btn btn-primary btn-block').attrs['href']
+    async def get_server_id(self, snapshot):
+        # Takes the page login already read, the server link is on it.
+        if snapshot.server_link is None:
+            raise BackendError(
+                "Could not find the server on the panel.", retryable=False
+            )
+        server_index = snapshot.server_link
         server_index_url = self.ApexHostingPanelLoginURL + server_index[1:]
-        self.driver.get(server_index_url)
-        element = None
-        try:
-            element = WebDriverWait(self.driver, self.get_timeout()).until(
-                EC.presence_of_element_located((By.ID, 'statusicon-ajax')))
-        except Exception:
-            pass
-        if element is None:
-            raise Exception("Server dashboard failed to load.")
-        url = self.driver.current_url
+        if not await self.load_page("server_index", server_index_url, status_icon_loaded):
+            raise BackendError("Server dashboard failed to load.")
+        url = await self.browser.call(lambda driver: driver.current_url)
         self.ServerID = url.split('/')[-1]
-        logging.debug("Server Id: ", self.ServerID)
+        logging.debug(f"Server Id: {self.ServerID}")
         return self.ServerID
-
-    def get_timeout(self):
-        return random.randint(self.min_timeout, self.max_timeout)
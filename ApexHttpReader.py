@@ -0,0 +1,107 @@
+import json
+import logging
+
+import aiohttp
+
+from ApexPageParser import (
+    parse_fragment,
+    parse_log_entries,
+    parse_panel_page,
+    parse_status,
+)
+
+# The status icon and the log are not in the page itself. Once it has loaded, the
+# panel's script posts these back to the page URL and fills the nodes in from the
+# JSON answer, so the reader asks for the same fragments directly.
+STATUS_REQUEST = {"ajax": "get_status"}
+STATUS_KEY = "statusicon"
+# The log answer carries a log_seq, sending it back only returns the lines after it.
+LOG_REQUEST = {"ajax": "refresh", "type": "all"}
+LOG_KEY = "log"
+LOG_SEQ_KEY = "log_seq"
+CSRF_TOKEN_NAME = "YII_CSRF_TOKEN"
+
+
+class ApexHttpReader:
+    def __init__(self, user_agent, timeout=15):
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.cookies = {}
+        self.session = None
+
+    @property
+    def has_session(self):
+        return bool(self.cookies)
+
+    def set_cookies(self, cookies):
+        self.cookies = {cookie["name"]: cookie["value"] for cookie in cookies}
+        if self.session is not None:
+            self.session.cookie_jar.clear()
+
+    def clear_cookies(self):
+        self.cookies = {}
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers={"User-Agent": self.user_agent},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def fetch_answer(self, url, request, key):
+        # Returns None whenever the caller should fall back to the browser.
+        if not self.has_session:
+            return None
+        data = dict(request)
+        if CSRF_TOKEN_NAME in self.cookies:
+            data[CSRF_TOKEN_NAME] = self.cookies[CSRF_TOKEN_NAME]
+        session = self.get_session()
+        try:
+            async with session.post(
+                url,
+                data=data,
+                cookies=self.cookies,
+                headers={"X-Requested-With": "XMLHttpRequest"},
+            ) as response:
+                if response.status != 200:
+                    logging.debug(f"Panel read failed with status {response.status}")
+                    return None
+                body = await response.text()
+        except aiohttp.ClientError as err:
+            logging.debug(f"Panel read failed: {err}")
+            return None
+        try:
+            answer = json.loads(body)
+            if isinstance(answer, dict) and key in answer:
+                return answer
+        except ValueError:
+            pass
+        # Anything else is usually the panel sending an expired session to its login page.
+        if parse_panel_page(body).login_form:
+            logging.debug("Panel cookies are no longer valid")
+            self.clear_cookies()
+        else:
+            logging.debug(f"Panel answered {request} without {key}")
+        return None
+
+    async def fetch_status(self, url):
+        answer = await self.fetch_answer(url, STATUS_REQUEST, STATUS_KEY)
+        if answer is None:
+            return None
+        return parse_status(parse_fragment(answer[STATUS_KEY]))
+
+    async def fetch_log(self, url, log_seq=None):
+        # Returns the entries and the panel's log_seq, which is None if it sent none.
+        request = dict(LOG_REQUEST, log_seq=log_seq or "0")
+        answer = await self.fetch_answer(url, request, LOG_KEY)
+        if answer is None:
+            return None
+        entries = parse_log_entries(parse_fragment(answer[LOG_KEY]))
+        log_seq = answer.get(LOG_SEQ_KEY)
+        return entries, str(log_seq) if log_seq is not None else None
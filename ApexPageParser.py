@@ -0,0 +1,101 @@
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+LOG_ENTRY_REGEX = re.compile(r"\d{2}.\d{2} \d{2}:\d{2}:\d{2}")
+TARGET_IDS = {"statusicon-ajax", "log-ajax", "logout_link", "LoginForm_name"}
+TARGET_CLASSES = {"errorMessage"}
+SERVER_LINK_CLASSES = {"btn", "btn-primary", "btn-block"}
+
+
+def get_classes(attrs):
+    classes = attrs.get("class") or []
+    if isinstance(classes, str):
+        classes = classes.split()
+    return set(classes)
+
+
+def is_target(name, attrs):
+    if attrs.get("id") in TARGET_IDS:
+        return True
+    classes = get_classes(attrs)
+    if classes & TARGET_CLASSES:
+        return True
+    return name == "a" and SERVER_LINK_CLASSES <= classes
+
+
+class PanelNodes(SoupStrainer):
+    # Only the nodes the bot reads are built, the rest of the page is skipped while
+    # parsing. bs4 4.12 asks search_tag and 4.13 asks allow_tag_creation.
+    def search_tag(self, name=None, attrs={}):
+        return is_target(name, attrs or {})
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return is_target(name, attrs or {})
+
+    def allow_string_creation(self, string):
+        return False
+
+
+PANEL_NODES = PanelNodes()
+
+
+class PanelSnapshot:
+    def __init__(
+        self,
+        status=None,
+        status_loaded=False,
+        log_entries=None,
+        logged_in=False,
+        login_form=False,
+        login_error=False,
+        server_link=None,
+    ):
+        self.status = status
+        self.status_loaded = status_loaded
+        self.log_entries = log_entries
+        self.logged_in = logged_in
+        self.login_form = login_form
+        self.login_error = login_error
+        self.server_link = server_link
+
+
+def parse_status(status_icon):
+    if status_icon is None or status_icon.img is None:
+        return None
+    img_source = status_icon.img.attrs["src"]
+    return img_source.split("/")[-1].split(".png")[0]
+
+
+def parse_log_entries(console_log):
+    if console_log is None:
+        return None
+    entries = LOG_ENTRY_REGEX.sub(lambda x: "\n" + x.group(0), console_log.text)
+    return list(filter(None, entries.split("\n")))
+
+
+def parse_fragment(fragment):
+    # AJAX answers hold the inner HTML of the node they fill in, and are small.
+    return BeautifulSoup(fragment, PARSER)
+
+
+def parse_panel_page(page_source):
+    soup = BeautifulSoup(page_source, PARSER, parse_only=PANEL_NODES)
+    status_icon = soup.find(id="statusicon-ajax")
+    server_link = soup.find("a", class_="btn btn-primary btn-block")
+    return PanelSnapshot(
+        status=parse_status(status_icon),
+        status_loaded=status_icon is not None,
+        log_entries=parse_log_entries(soup.find(id="log-ajax")),
+        logged_in=soup.find(id="logout_link") is not None,
+        login_form=soup.find(id="LoginForm_name") is not None,
+        login_error=soup.find(class_="errorMessage") is not None,
+        server_link=server_link.attrs["href"] if server_link is not None else None,
+    )
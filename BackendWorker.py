@@ -0,0 +1,417 @@
+import asyncio
+import itertools
+import logging
+import os
+import pickle
+import struct
+import sys
+
+from Metrics import Counter, registry
+from RateLimiter import request_priority
+from Resilience import BackendError, CircuitBreaker
+from StatusWaiter import TransitionStats
+
+WORKER_PATH = os.path.abspath(__file__)
+FRAME_HEADER = struct.Struct("<I")
+RESTARTS = Counter(
+    "backend_worker_restarts_total", "Backend worker process restarts", ["server"]
+)
+
+
+def write_frame(writer, message):
+    data = pickle.dumps(message)
+    writer.write(FRAME_HEADER.pack(len(data)) + data)
+
+
+async def read_frame(reader):
+    size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))[0]
+    return pickle.loads(await reader.readexactly(size))
+
+
+def picklable(value):
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+class RemoteBackend:
+    def __init__(
+        self,
+        name,
+        config,
+        rate_limiter=None,
+        ping_interval=15,
+        ping_timeout=10,
+        start_timeout=120,
+    ):
+        self.name = name
+        self.config = config
+        # The worker asks for its API tokens here, so one budget covers every process.
+        self.rate_limiter = rate_limiter
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.start_timeout = start_timeout
+        self.circuit_breaker = CircuitBreaker(f"worker:{name}")
+        self.transition_stats = TransitionStats()
+        # Filled in place once the worker reports in, so holders see the values.
+        self.transitional_statuses = set()
+        self.action_targets = {}
+        self.process = None
+        self.spawn_lock = asyncio.Lock()
+        self.restarting = False
+        self.ready = None
+        self.read_task = None
+        self.monitor_task = None
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.restarts = 0
+        self.closed = False
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def spawn(self):
+        logging.info(f"Starting backend worker for {self.name}")
+        self.ready = asyncio.get_running_loop().create_future()
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            WORKER_PATH,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        write_frame(self.process.stdin, ("config", self.name, self.config))
+        self.read_task = asyncio.ensure_future(
+            self.read_loop(self.process, self.ready)
+        )
+
+    async def ensure_started(self):
+        if self.closed:
+            raise BackendError(f"Backend worker for {self.name} is closed")
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.ensure_future(self.monitor())
+        if not self.running:
+            # A restart holds the lock through its back-off, so callers wait for the
+            # process it starts rather than starting one of their own.
+            async with self.spawn_lock:
+                if not self.running and not self.closed:
+                    await self.spawn()
+        await asyncio.wait_for(asyncio.shield(self.ready), self.start_timeout)
+
+    async def read_loop(self, process, ready):
+        try:
+            while True:
+                self.dispatch(await read_frame(process.stdout), process)
+        except (asyncio.IncompleteReadError, ConnectionError, pickle.UnpicklingError):
+            pass
+        finally:
+            err = BackendError(f"Backend worker for {self.name} exited")
+            if not ready.done():
+                ready.set_exception(err)
+                # Nobody may be waiting on it, so do not warn about it being unread.
+                ready.exception()
+            # A replacement may already be running, its calls are not ours to fail.
+            if process is self.process:
+                self.fail_pending(err)
+
+    def dispatch(self, message, process):
+        kind = message[0]
+        if kind == "ready":
+            self.transitional_statuses.update(message[1]["transitional_statuses"])
+            self.action_targets.update(message[1]["action_targets"])
+            self.ready.set_result(True)
+            return
+        if kind == "acquire":
+            asyncio.ensure_future(self.grant(process, message[1], message[2]))
+            return
+        if kind == "rate_headers":
+            if self.rate_limiter is not None:
+                self.rate_limiter.update_from_headers(message[1])
+            return
+        if kind == "rate_block":
+            if self.rate_limiter is not None:
+                self.rate_limiter.block_for(message[1])
+            return
+        future, updates = self.pending.get(message[1], (None, None))
+        if future is None or future.done():
+            return
+        if kind in ("result", "pong"):
+            future.set_result(message[2])
+        elif kind == "error":
+            future.set_exception(message[2])
+        elif kind == "progress" and updates is not None:
+            updates.put_nowait((message[2], message[3]))
+
+    async def grant(self, process, request_id, priority):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(priority)
+        try:
+            write_frame(process.stdin, ("granted", request_id))
+            await process.stdin.drain()
+        except (ConnectionError, RuntimeError) as err:
+            logging.debug(f"Backend worker for {self.name} went away: {err}")
+
+    def fail_pending(self, err):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(err)
+        self.pending.clear()
+
+    async def request(self, message, on_progress=None):
+        call_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        updates = asyncio.Queue() if on_progress is not None else None
+        self.pending[call_id] = (future, updates)
+        try:
+            write_frame(self.process.stdin, (message[0], call_id) + message[1:])
+            await self.process.stdin.drain()
+            if updates is None:
+                return await future
+            return await self.follow_progress(future, updates, on_progress)
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def follow_progress(self, future, updates, on_progress):
+        # Updates are applied one at a time in the order they were sent, and all of
+        # them before the result is returned, so a late one cannot overwrite it.
+        while not future.done() or not updates.empty():
+            if updates.empty():
+                getter = asyncio.ensure_future(updates.get())
+                try:
+                    await asyncio.wait(
+                        {future, getter}, return_when=asyncio.FIRST_COMPLETED
+                    )
+                finally:
+                    if not getter.done():
+                        getter.cancel()
+                if getter.cancelled():
+                    continue
+                seen, elapsed = getter.result()
+            else:
+                seen, elapsed = updates.get_nowait()
+            try:
+                await on_progress(seen, elapsed)
+            except Exception as err:
+                logging.error(f"Progress update from {self.name} failed: {err}")
+        return future.result()
+
+    async def call(self, method, *args, on_progress=None, **kwargs):
+        await self.ensure_started()
+        return await self.request(
+            (
+                "call",
+                method,
+                args,
+                kwargs,
+                on_progress is not None,
+                request_priority.get(),
+            ),
+            on_progress,
+        )
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def remote_call(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
+
+        remote_call.__name__ = name
+        return remote_call
+
+    async def wait_for_status(
+        self, targets, timeout=600, on_progress=None, require_change=False
+    ):
+        return await self.call(
+            "wait_for_status",
+            targets,
+            timeout=timeout,
+            on_progress=on_progress,
+            require_change=require_change,
+        )
+
+    async def restart(self, reason, process=None):
+        async with self.spawn_lock:
+            # Someone else already replaced the process this restart was meant for.
+            if process is not None and process is not self.process:
+                return
+            self.restarting = True
+            try:
+                logging.warning(f"Restarting backend worker for {self.name}: {reason}")
+                self.restarts += 1
+                RESTARTS.inc(server=self.name)
+                if self.running:
+                    self.process.kill()
+                    await self.process.wait()
+                # Back off when the worker keeps dying straight after starting.
+                await asyncio.sleep(min(60, 2 ** min(self.restarts, 6)))
+                if not self.closed:
+                    await self.spawn()
+            finally:
+                self.restarting = False
+
+    async def monitor(self):
+        while not self.closed:
+            await asyncio.sleep(self.ping_interval)
+            if self.process is None or self.restarting or not self.ready.done():
+                continue
+            process = self.process
+            if not self.running:
+                await self.restart(f"exited with code {process.returncode}", process)
+                continue
+            try:
+                snapshot = await asyncio.wait_for(
+                    self.request(("ping",)), self.ping_timeout
+                )
+            except (asyncio.TimeoutError, BackendError, ConnectionError) as err:
+                await self.restart(f"health check failed: {err!r}", process)
+            else:
+                self.restarts = 0
+                # The worker's own metrics ride along so /metrics covers it too.
+                registry.set_remote(self.name, snapshot)
+
+    async def close(self):
+        self.closed = True
+        registry.remove_remote(self.name)
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        if not self.running:
+            return
+        try:
+            write_frame(self.process.stdin, ("stop",))
+            await self.process.stdin.drain()
+            await asyncio.wait_for(self.process.wait(), 10)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.process.kill()
+            await self.process.wait()
+
+
+class RemoteRateLimiter:
+    # Takes the place of the backend's own limiter inside a worker and forwards to the
+    # gateway's, which keeps the per-token budget and its user-first ordering.
+    HEADERS = ("X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.grants = {}
+        self.ids = itertools.count(1)
+
+    async def acquire(self, priority=None):
+        if priority is None:
+            priority = request_priority.get()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.grants[request_id] = future
+        try:
+            write_frame(self.writer, ("acquire", request_id, priority))
+            await future
+        finally:
+            self.grants.pop(request_id, None)
+
+    def granted(self, request_id):
+        future = self.grants.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    def update_from_headers(self, headers):
+        values = {
+            name: headers.get(name)
+            for name in self.HEADERS
+            if headers.get(name) is not None
+        }
+        if values:
+            write_frame(self.writer, ("rate_headers", values))
+
+    def block_for(self, seconds):
+        write_frame(self.writer, ("rate_block", seconds))
+
+
+async def handle_call(
+    backend, writer, call_id, method, args, kwargs, progress, priority
+):
+    # Calls the gateway made at background priority stay background in the worker.
+    request_priority.set(priority)
+    if progress:
+
+        async def on_progress(seen, elapsed):
+            write_frame(writer, ("progress", call_id, list(seen), elapsed))
+
+        kwargs["on_progress"] = on_progress
+    try:
+        result = await getattr(backend, method)(*args, **kwargs)
+        message = ("result", call_id, result)
+    except Exception as err:
+        if not picklable(err):
+            err = BackendError(f"{type(err).__name__}: {err}")
+        message = ("error", call_id, err)
+    if not picklable(message):
+        message = ("error", call_id, BackendError(f"{method} returned {message[2]!r}"))
+    write_frame(writer, message)
+
+
+async def serve():
+    # Anything a library prints would corrupt the frames, so stdout goes to stderr
+    # and the frames use a private copy of the original stdout.
+    frames_out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer
+    )
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, frames_out
+    )
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    from LogSetup import parse_level
+    from ServerRegistry import create_backend
+
+    _, name, config = await read_frame(reader)
+    logging.basicConfig(
+        format=f"%(asctime)s: [%(levelname)s] [worker {name}] %(message)s",
+        level=parse_level(os.getenv("LOG_LEVEL")),
+    )
+    backend = create_backend(config)
+    rate_limiter = None
+    if getattr(backend, "rate_limiter", None) is not None:
+        rate_limiter = backend.rate_limiter = RemoteRateLimiter(writer)
+    write_frame(
+        writer,
+        (
+            "ready",
+            {
+                "transitional_statuses": list(backend.transitional_statuses),
+                "action_targets": backend.action_targets,
+            },
+        ),
+    )
+    tasks = set()
+    try:
+        while True:
+            try:
+                message = await read_frame(reader)
+            except asyncio.IncompleteReadError:
+                # The gateway went away, there is nobody left to answer.
+                break
+            if message[0] == "stop":
+                break
+            if message[0] == "ping":
+                write_frame(writer, ("pong", message[1], registry.snapshot()))
+            elif message[0] == "granted" and rate_limiter is not None:
+                rate_limiter.granted(message[1])
+            elif message[0] == "call":
+                task = asyncio.ensure_future(handle_call(backend, writer, *message[1:]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await backend.close()
+        logging.info(f"Backend worker for {name} stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -0,0 +1,206 @@
+import asyncio
+import itertools
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from BrowserWorker import BrowserWorker
+from Metrics import Counter, Gauge
+from Resilience import BackendError
+
+RECYCLED = Counter("browser_recycled_total", "Browsers retired by the pool", ["reason"])
+BROWSER_RSS = Gauge("browser_rss_bytes", "Memory used by a pooled browser", ["browser"])
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_parent_pids():
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # The command name can contain spaces, the fields after it cannot.
+        fields = stat[stat.rfind(")") + 2 :].split()
+        parents[int(entry)] = int(fields[1])
+    return parents
+
+
+def process_tree_rss(pid):
+    # Chrome runs as a tree of processes, so the renderers have to be counted too.
+    parents = read_parent_pids()
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, parent in parents.items() if parent in tree}
+        changed = not children <= tree
+        tree |= children
+    total = 0
+    for member in tree:
+        try:
+            with open(f"/proc/{member}/statm") as statm_file:
+                total += int(statm_file.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+    return total
+
+
+def driver_rss(driver):
+    pid = getattr(driver, "browser_pid", None)
+    if pid is None:
+        service = getattr(driver, "service", None)
+        process = getattr(service, "process", None)
+        pid = getattr(process, "pid", None)
+    if pid is None or not os.path.isdir("/proc"):
+        return None
+    return process_tree_rss(pid)
+
+
+class BrowserPool:
+    def __init__(
+        self,
+        create_driver,
+        size=2,
+        max_uses=50,
+        max_rss_mb=1024,
+        warm=None,
+        name="browser",
+        retire_on=(),
+        checkout_timeout=120,
+    ):
+        self.create_driver = create_driver
+        self.size = size
+        self.max_uses = max_uses
+        self.max_rss = max_rss_mb * 1024 * 1024 if max_rss_mb else None
+        self.warm = warm
+        self.name = name
+        # Errors that mean the browser itself is broken, e.g. Chrome having crashed.
+        self.retire_on = tuple(retire_on)
+        self.checkout_timeout = checkout_timeout
+        self.last_error = None
+        self.ids = itertools.count(1)
+        self.idle = None
+        self.browsers = set()
+        self.tasks = set()
+        self.waiting = 0
+        self.closed = False
+
+    def start(self):
+        if self.idle is not None:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Started again from the first checkout once the bot's loop is running.
+            return
+        self.idle = asyncio.Queue()
+        for _ in range(self.size):
+            self.spawn()
+
+    def spawn(self):
+        task = asyncio.ensure_future(self.add_browser())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def add_browser(self):
+        attempt = 0
+        while not self.closed:
+            attempt += 1
+            browser = BrowserWorker(
+                self.create_driver, name=f"{self.name}-{next(self.ids)}"
+            )
+            try:
+                # Waits for the driver to start, and raises if it could not.
+                await browser.call(lambda driver: None)
+                if self.warm is not None:
+                    await self.warm(browser)
+            except Exception as err:
+                browser.stop()
+                self.last_error = err
+                delay = min(60, 2**attempt)
+                logging.error(f"Could not warm {browser.name}, retrying in {delay}s: {err}")
+                await asyncio.sleep(delay)
+                continue
+            if self.closed:
+                browser.stop()
+                return
+            self.last_error = None
+            self.browsers.add(browser)
+            self.idle.put_nowait(browser)
+            logging.info(f"{browser.name} is warm, {self.idle.qsize()} idle")
+            return
+
+    @asynccontextmanager
+    async def checkout(self):
+        self.start()
+        if self.idle.empty():
+            logging.info(f"Waiting for a browser, {self.waiting} already waiting")
+        self.waiting += 1
+        try:
+            # Browsers that cannot be started are retried forever in the background,
+            # so a command gives up instead of waiting on them with it.
+            browser = await asyncio.wait_for(self.idle.get(), self.checkout_timeout)
+        except asyncio.TimeoutError:
+            reason = self.last_error or "all browsers are busy"
+            raise BackendError(
+                f"No browser available after {self.checkout_timeout:.0f}s: {reason}",
+                retryable=False,
+            ) from None
+        finally:
+            self.waiting -= 1
+        failure = None
+        try:
+            yield browser
+        except self.retire_on as err:
+            failure = err
+            raise
+        finally:
+            browser.uses += 1
+            self.checkin(browser, failure)
+
+    def checkin(self, browser, failure=None):
+        # Recycling checks read /proc, so they run after the caller has its answer.
+        task = asyncio.ensure_future(self.recycle_or_return(browser, failure))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def recycle_or_return(self, browser, failure=None):
+        reason = None
+        if self.closed:
+            reason = "closed"
+        elif failure is not None:
+            logging.warning(f"{browser.name} failed, replacing it: {failure!r}")
+            reason = "error"
+        elif browser.uses >= self.max_uses:
+            reason = "uses"
+        elif self.max_rss is not None:
+            try:
+                rss = await browser.call(driver_rss)
+            except Exception as err:
+                logging.debug(f"Could not measure {browser.name}: {err}")
+                rss = None
+            if rss is not None:
+                BROWSER_RSS.set(rss, browser=browser.name)
+                if rss > self.max_rss:
+                    reason = "memory"
+        if reason is None:
+            self.idle.put_nowait(browser)
+            return
+        logging.info(f"Retiring {browser.name} after {browser.uses} uses ({reason})")
+        RECYCLED.inc(reason=reason)
+        self.browsers.discard(browser)
+        BROWSER_RSS.remove(browser=browser.name)
+        browser.stop()
+        if not self.closed:
+            self.spawn()
+
+    async def close(self):
+        self.closed = True
+        for task in list(self.tasks):
+            task.cancel()
+        for browser in self.browsers:
+            browser.stop()
+        self.browsers.clear()
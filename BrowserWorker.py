@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import queue
+import threading
+
+
+class BrowserWorker:
+    def __init__(self, create_driver, name="browser-worker"):
+        self.name = name
+        self.driver = None
+        self.uses = 0
+        self.cookie_generation = None
+        self.startup_error = None
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.work, args=(create_driver,), name=name, daemon=True
+        )
+        self.thread.start()
+
+    @property
+    def pending(self):
+        return self.jobs.qsize()
+
+    def work(self, create_driver):
+        # The driver is created and used only on this thread, so calls never interleave.
+        try:
+            self.driver = create_driver()
+        except Exception as err:
+            logging.exception(f"Could not start browser: {err}")
+            self.startup_error = err
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            func, args, future, loop = job
+            try:
+                if self.startup_error is not None:
+                    raise self.startup_error
+                result = func(self.driver, *args)
+            except Exception as err:
+                loop.call_soon_threadsafe(self.set_exception, future, err)
+            else:
+                loop.call_soon_threadsafe(self.set_result, future, result)
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception as err:
+                logging.error(f"Could not quit browser: {err}")
+
+    @staticmethod
+    def set_result(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def set_exception(future, err):
+        if not future.done():
+            future.set_exception(err)
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.jobs.put((func, args, future, loop))
+        return await future
+
+    def stop(self):
+        self.jobs.put(None)
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from StatusWaiter import StatusTracker
+
+# Commands that move the server the same way can queue up behind each other,
+# commands that pull it the other way are turned down while one is pending or
+# its transition is still under way.
+ACTION_DIRECTIONS = {
+    "start": "up",
+    "force_start": "up",
+    "restart": "up",
+    "stop": "down",
+    "force_stop": "down",
+}
+
+
+class CommandRejected(Exception):
+    pass
+
+
+class CommandActor:
+    def __init__(self, name):
+        self.name = name
+        self.queue = asyncio.Queue()
+        self.pending = {}
+        self.trackers = {}
+        self.task = None
+
+    def find_conflict(self, action):
+        direction = ACTION_DIRECTIONS.get(action)
+        for pending_action in self.pending:
+            if ACTION_DIRECTIONS.get(pending_action) != direction:
+                return pending_action
+        return None
+
+    async def submit(self, action, func, follow=None, follow_if=None):
+        future = self.pending.get(action)
+        if future is not None:
+            logging.info(f"Joining the pending {action} of {self.name}")
+        else:
+            conflict = self.find_conflict(action)
+            if conflict is not None:
+                raise CommandRejected(
+                    f"Cannot {action.replace('_', ' ')} {self.name}: "
+                    f"a {conflict.replace('_', ' ')} is already in progress"
+                )
+            future = asyncio.get_running_loop().create_future()
+            self.pending[action] = future
+            self.queue.put_nowait((action, func, follow, follow_if, future))
+            if self.task is None or self.task.done():
+                self.task = asyncio.ensure_future(self.run())
+        # Shielded so one requester giving up does not cancel it for the others.
+        return await asyncio.shield(future)
+
+    async def run(self):
+        while not self.queue.empty():
+            action, func, follow, follow_if, future = self.queue.get_nowait()
+            logging.info(f"Running {action} of {self.name}")
+            tracker = None
+            try:
+                result = await func()
+                # Started before the result is handed out, so every requester
+                # follows the same status wait. A command the backend turned down
+                # moves nothing, so it is not followed and stops being pending.
+                issued = result is not None if follow_if is None else follow_if(result)
+                if follow is not None and issued:
+                    tracker = self.trackers[action] = StatusTracker(follow)
+                else:
+                    self.trackers.pop(action, None)
+                future.set_result(result)
+                if tracker is not None:
+                    await self.finish_transition(action, tracker)
+            except Exception as err:
+                if not future.done():
+                    future.set_exception(err)
+            finally:
+                self.pending.pop(action, None)
+
+    async def finish_transition(self, action, tracker):
+        # The command stays pending until the server gets where it was sent or the
+        # wait times out, so a contradictory command is turned down meanwhile.
+        try:
+            await tracker.follow()
+        except Exception as err:
+            logging.error(f"Waiting for the {action} of {self.name} failed: {err}")
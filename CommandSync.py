@@ -0,0 +1,61 @@
+import hashlib
+import json
+import logging
+import os
+
+
+class CommandSyncCache:
+    def __init__(self, path="command_sync.json"):
+        self.path = path
+
+    def definition_hash(self, bot):
+        definitions = sorted(
+            (cmd.to_dict() for cmd in bot.pending_application_commands),
+            key=lambda definition: definition["name"],
+        )
+        payload = json.dumps(
+            {"application_id": bot.user.id, "commands": definitions},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError) as err:
+            logging.warning(f"Ignoring unreadable command sync cache: {err}")
+            return None
+
+    def save(self, definition_hash, bot):
+        data = {
+            "hash": definition_hash,
+            "ids": {cmd.name: cmd.id for cmd in bot.pending_application_commands},
+        }
+        with open(self.path, "w") as cache_file:
+            json.dump(data, cache_file)
+
+    def restore(self, bot, ids):
+        for cmd in bot.pending_application_commands:
+            if ids.get(cmd.name) is None:
+                return False
+        for cmd in bot.pending_application_commands:
+            cmd.id = ids[cmd.name]
+            # Interactions are routed by command id, which normally only a sync fills in.
+            bot._application_commands[cmd.id] = cmd
+        return True
+
+    async def sync(self, bot):
+        definition_hash = self.definition_hash(bot)
+        cached = self.load()
+        if cached is not None and cached.get("hash") == definition_hash:
+            if self.restore(bot, cached.get("ids", {})):
+                logging.info("Slash commands unchanged, skipping sync")
+                return False
+        await bot.sync_commands()
+        self.save(definition_hash, bot)
+        logging.info("Slash commands synced")
+        return True
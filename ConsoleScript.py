@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+import re
+
+MAX_STEPS = 20
+MAX_DELAY = 300
+# Keeps a whole script well inside the 15 minutes an interaction can still be edited.
+MAX_TOTAL_DELAY = 600
+
+DEFAULT_MACROS = {
+    "save": ["SaveWorld"],
+    "shutdown": [
+        "ServerChat Server is shutting down in 1 minute!",
+        "wait 60",
+        "SaveWorld",
+        "wait 5",
+        "DoExit",
+    ],
+}
+
+wait_regex = re.compile(r"^(?:wait|sleep)\s+(\d+(?:\.\d+)?)$", re.IGNORECASE)
+
+
+def load_macros(path=None):
+    macros = dict(DEFAULT_MACROS)
+    path = path or os.getenv("RCON_MACROS_FILE", "macros.json")
+    if os.path.exists(path):
+        try:
+            with open(path) as macros_file:
+                macros.update(json.load(macros_file))
+        except Exception as err:
+            logging.error(f"Could not load console macros from {path}: {err}")
+    return macros
+
+
+def parse_console_script(script, macros):
+    if script.strip() in macros:
+        lines = macros[script.strip()]
+    else:
+        # Slash command options are single line, so ';' separates steps as well.
+        lines = re.split(r"[;\n]", script)
+    steps = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        match = wait_regex.match(line)
+        if match is not None:
+            if not steps:
+                raise ValueError("A script cannot start with a wait")
+            delay = float(match.group(1))
+            if delay > MAX_DELAY:
+                raise ValueError(f"Waits cannot be longer than {MAX_DELAY} seconds")
+            command, previous = steps[-1]
+            steps[-1] = (command, previous + delay)
+            continue
+        steps.append((line, 0))
+    if not steps:
+        raise ValueError("The script has no commands")
+    if len(steps) > MAX_STEPS:
+        raise ValueError(f"Scripts cannot have more than {MAX_STEPS} commands")
+    if sum(delay for _, delay in steps) > MAX_TOTAL_DELAY:
+        raise ValueError(
+            f"Scripts cannot wait more than {MAX_TOTAL_DELAY} seconds in total"
+        )
+    return steps
@@ -0,0 +1,79 @@
+import atexit
+import json
+import logging
+import queue
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+
+TEXT_FORMAT = "%(asctime)s: [%(levelname)s] %(message)s"
+# Extra fields callers can attach to a record, e.g. logging.info(..., extra={...}).
+CONTEXT_FIELDS = ("command", "user_id", "server", "latency")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock prepare formats the message and drops exc_info on the calling thread.
+    # The queue never leaves this process, so the record is handed over as it is and
+    # the listener's formatters do all of the formatting.
+    def prepare(self, record):
+        return record
+
+
+def parse_level(level):
+    if level is None:
+        return logging.INFO
+    return int(level) if str(level).isdigit() else str(level).upper()
+
+
+def setup_logging(
+    level=logging.INFO,
+    log_file="discord.log",
+    json_format=False,
+    max_bytes=10 * 1024 * 1024,
+    backup_count=5,
+    rotate_when=None,
+):
+    if rotate_when:
+        file_handler = TimedRotatingFileHandler(
+            log_file, when=rotate_when, backupCount=backup_count, encoding="utf-8"
+        )
+    else:
+        file_handler = RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    handlers = [file_handler, logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # The loop only puts records on a queue, the file writes happen on the listener thread.
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(parse_level(level))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
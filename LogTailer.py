@@ -0,0 +1,34 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+
+class LogTailer:
+    def __init__(self, fetch, max_lines=500, refresh_interval=10):
+        self.fetch = fetch
+        self.lines = deque(maxlen=max_lines)
+        self.cursor = None
+        self.refresh_interval = refresh_interval
+        self.refreshed_at = 0
+        self.lock = asyncio.Lock()
+
+    async def refresh(self, force=False):
+        async with self.lock:
+            # Anyone who queued behind the lock gets the lines that were just fetched.
+            if not force and time.monotonic() - self.refreshed_at < self.refresh_interval:
+                return
+            new_lines, self.cursor = await self.fetch(self.cursor)
+            self.lines.extend(new_lines)
+            self.refreshed_at = time.monotonic()
+            logging.debug(f"Log tailer read {len(new_lines)} new lines")
+
+    async def get_lines(self, count, search=None):
+        await self.refresh()
+        lines = list(self.lines)
+        if search:
+            # Plain text only: a user supplied regex could backtrack for minutes and
+            # hold up the event loop.
+            search = search.lower()
+            lines = [line for line in lines if search in line.lower()]
+        return lines[-count:]
@@ -0,0 +1,258 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape_label(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        # Values reported by worker processes, merged into the local ones on render.
+        self.remote = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # Collectors are called on every scrape for values that live elsewhere.
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        return [(metric.spec(), metric.values) for metric in self.metrics]
+
+    def set_remote(self, source, snapshot):
+        self.remote[source] = snapshot
+
+    def remove_remote(self, source):
+        self.remote.pop(source, None)
+
+    def render(self):
+        remote = {}
+        for snapshot in self.remote.values():
+            for spec, values in snapshot:
+                remote.setdefault(spec["name"], (spec, []))[1].append(values)
+        lines = []
+        for metric in self.metrics:
+            _, values = remote.pop(metric.name, (None, []))
+            lines.extend(metric.render(values))
+        # Metrics only a worker has, e.g. those of a backend the gateway never imports.
+        for spec, values in remote.values():
+            lines.extend(build_metric(spec).render(values))
+        for collector in self.collectors:
+            try:
+                for metric in collector():
+                    lines.extend(metric.render())
+            except Exception as err:
+                logging.error(f"Metrics collector {collector} failed: {err}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=(), register=True):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        if register:
+            registry.register(self)
+
+    def spec(self):
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "description": self.description,
+            "labels": self.labels,
+        }
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def merge(self, value, other):
+        return value + other
+
+    def merged_values(self, remote=()):
+        values = dict(self.values)
+        for remote_values in remote:
+            for key, value in remote_values.items():
+                values[key] = self.merge(values[key], value) if key in values else value
+        return values
+
+    def render(self, remote=()):
+        lines = self.header()
+        for key, value in sorted(self.merged_values(remote).items()):
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def remove(self, **labels):
+        self.values.pop(self.key(labels), None)
+
+    def merge(self, value, other):
+        return other
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name, description, labels=(), buckets=DEFAULT_BUCKETS, register=True
+    ):
+        super().__init__(name, description, labels, register=register)
+        self.buckets = tuple(buckets)
+
+    def spec(self):
+        return dict(super().spec(), buckets=self.buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0]
+        counts, _, _ = entry = self.values[key]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def merge(self, value, other):
+        counts = [a + b for a, b in zip(value[0], other[0])]
+        return [counts, value[1] + other[1], value[2] + other[2]]
+
+    def render(self, remote=()):
+        lines = self.header()
+        for key, (counts, total, count) in sorted(self.merged_values(remote).items()):
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), key + (bucket,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+METRIC_TYPES = {
+    metric_type.kind: metric_type for metric_type in (Metric, Counter, Gauge, Histogram)
+}
+
+
+def build_metric(spec):
+    spec = dict(spec)
+    return METRIC_TYPES[spec.pop("kind")](register=False, **spec)
+
+
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up a timer",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+async def monitor_loop_lag(interval=1):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0, time.monotonic() - start - interval))
+
+
+class MetricsServer:
+    def __init__(self, health_check, port=80):
+        self.health_check = health_check
+        self.port = port
+        self.runner = None
+        self.lag_task = None
+
+    async def metrics(self, request):
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def healthz(self, request):
+        healthy, details = self.health_check()
+        return web.Response(
+            text=json.dumps(details),
+            status=200 if healthy else 503,
+            content_type="application/json",
+        )
+
+    async def start(self):
+        if self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/healthz", self.healthz)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, port=self.port).start()
+        except BaseException:
+            await runner.cleanup()
+            raise
+        # Only kept once the port is bound, so a failed start can be tried again.
+        self.runner = runner
+        self.lag_task = asyncio.ensure_future(monitor_loop_lag())
+        logging.info(f"Serving metrics on port {self.port}")
+
+    async def stop(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        if self.runner is not None:
+            await self.runner.cleanup()
+        self.runner = None
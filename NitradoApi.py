@@ -1,23 +1,108 @@
+import logging
 import os
 import random
 import time
 import re
-import requests
+import aiohttp
 from dotenv import load_dotenv
-from rcon.source import Client
+
+from LogTailer import LogTailer
+from Metrics import Gauge, Histogram, registry
+from RateLimiter import RateLimiter
+from RconPool import RconPool
+from Resilience import BackendError, CircuitBreaker
+from StatusCache import StatusCache
+from StatusWaiter import TransitionStats, wait_for_status
 
 load_dotenv()
 
+logger = logging.getLogger("NitradoApi")
+logger.setLevel(os.getenv("NITRADO_LOG_LEVEL", "INFO").upper())
+
+REQUEST_SECONDS = Histogram(
+    "nitrado_request_seconds",
+    "Nitrado API request latency",
+    ["method", "path", "status"],
+)
+
+# Nitrado counts requests per token, so every server using one token shares a budget.
+rate_limiters = {}
+
+
+def get_rate_limiter(token, name):
+    if token not in rate_limiters:
+        rate_limit = int(os.getenv("NITRADO_RATE_LIMIT", 5000))
+        rate_limiters[token] = RateLimiter(
+            name,
+            rate=rate_limit / 3600,
+            capacity=int(os.getenv("NITRADO_RATE_BURST", 10)),
+        )
+    return rate_limiters[token]
+
+
+def collect_rate_limits():
+    gauges = {
+        key: Gauge(
+            f"nitrado_rate_limit_{key}",
+            f"Nitrado rate limit {key}",
+            ["limiter"],
+            register=False,
+        )
+        for key in ["tokens", "remaining", "waiting", "throttled"]
+    }
+    for limiter in rate_limiters.values():
+        for key, value in limiter.budget().items():
+            if key in gauges and value is not None:
+                gauges[key].set(value, limiter=limiter.name)
+    return gauges.values()
+
+
+registry.add_collector(collect_rate_limits)
+
 
 class NitradoApi:
-    def __init__(self):
-        self.NITRADO_TOKEN = os.getenv("NITRADO_TOKEN")
-        self.SERVER_ID = os.getenv("SERVER_ID")
-        self.RCON_IP_FULL = os.getenv("RCON_IP_FULL")
+    API_URL = os.getenv("NITRADO_API_URL", "https://api.nitrado.net")
+    LOG_TAIL_BYTES = 64 * 1024
+
+    def __init__(
+        self,
+        server_id=None,
+        token=None,
+        rcon_address=None,
+        rcon_password=None,
+        log_file=None,
+    ):
+        self.NITRADO_TOKEN = token or os.getenv("NITRADO_TOKEN")
+        self.SERVER_ID = server_id or os.getenv("SERVER_ID")
+        self.RCON_IP_FULL = rcon_address or os.getenv("RCON_IP_FULL")
         split = self.RCON_IP_FULL.split(":")
-        self.RCON_PWD = os.getenv("RCON_PWD")
+        self.RCON_PWD = rcon_password or os.getenv("RCON_PWD")
         self.RCON_IP = split[0]
         self.RCON_PORT = int(split[1])
+        self.rcon_pool = RconPool(
+            self.RCON_IP,
+            self.RCON_PORT,
+            self.RCON_PWD,
+            max_size=int(os.getenv("RCON_POOL_SIZE", 2)),
+        )
+        self.REQUEST_TIMEOUT = float(os.getenv("NITRADO_TIMEOUT", 15))
+        self.MAX_CONNECTIONS = int(os.getenv("NITRADO_MAX_CONNECTIONS", 10))
+        self.session = None
+        self.circuit_breaker = CircuitBreaker(f"nitrado:{self.SERVER_ID}")
+        self.rate_limiter = get_rate_limiter(
+            self.NITRADO_TOKEN, f"nitrado:{self.SERVER_ID}"
+        )
+        self.status_cache = StatusCache(ttl=float(os.getenv("STATUS_CACHE_TTL", 5)))
+        self.LOG_FILE = log_file or os.getenv("NITRADO_LOG_FILE")
+        self.action_targets = {
+            "start": ["Started"],
+            "stop": ["Stopped"],
+            "restart": ["Started"],
+        }
+        self.transition_stats = TransitionStats()
+        self.log_tailer = LogTailer(
+            self.fetch_console_log, max_lines=int(os.getenv("LOG_BUFFER_LINES", 500))
+        )
         self.status_codes = {
             "started": "Started",
             "stopped": "Stopped",
@@ -31,18 +116,93 @@ class NitradoApi:
             "chunkfix": "Runnign Minecraft chunkfix",
             "overviewmap_render": "Running Minecraft Overview Map rendering",
         }
+        self.transitional_statuses = {
+            self.status_codes[code]
+            for code in [
+                "stopping",
+                "restarting",
+                "gs_installation",
+                "backup_restore",
+                "backup_creation",
+            ]
+        }
         pass
 
+    def get_session(self):
+        # The session has to be created from inside the running event loop, so it is
+        # built on first use and then kept for the life of the bot to reuse connections.
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers={"Authorization": "Bearer " + self.NITRADO_TOKEN},
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT),
+                connector=aiohttp.TCPConnector(
+                    limit=self.MAX_CONNECTIONS, keepalive_timeout=60
+                ),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        await self.rcon_pool.close()
+
+    async def request(self, method, path, params=None):
+        await self.rate_limiter.acquire()
+        session = self.get_session()
+        start = time.monotonic()
+        status = "error"
+        try:
+            async with session.request(
+                method,
+                f"{self.API_URL}/services/{self.SERVER_ID}/gameservers{path}",
+                params=params,
+            ) as response:
+                content = await response.read()
+                status = response.status
+                return await self.handle_response(response, content)
+        finally:
+            REQUEST_SECONDS.observe(
+                time.monotonic() - start, method=method, path=path, status=status
+            )
+
+    async def handle_response(self, response, content):
+        logger.debug("Status Code: %s", response.status)
+        logger.debug("Response: %s", content)
+        self.rate_limiter.update_from_headers(response.headers)
+        if response.status in (401, 403, 429) or response.status >= 500:
+            retry_after = response.headers.get("Retry-After", "")
+            retry_after = float(retry_after) if retry_after.isdigit() else None
+            if response.status == 429:
+                self.rate_limiter.block_for(retry_after or 60)
+            raise BackendError(
+                f"Nitrado request failed with status {response.status}",
+                status=response.status,
+                retry_after=retry_after,
+            )
+        response_json = await response.json(content_type=None)
+        return response.status, response_json
+
     async def get_server_status(self):
-        print("Getting Server Status")
-        response = requests.get(
-            f"https://api.nitrado.net/services/{self.SERVER_ID}/gameservers",
-            auth=BearerAuth(self.NITRADO_TOKEN),
+        return await self.status_cache.get(self.fetch_server_status)
+
+    async def wait_for_status(
+        self, targets, timeout=600, on_progress=None, require_change=False
+    ):
+        result = await wait_for_status(
+            self.fetch_server_status,
+            targets,
+            timeout=timeout,
+            on_progress=on_progress,
+            require_change=require_change,
         )
-        print("Status Code: " + str(response.status_code))
-        print("Response: " + str(response.content))
-        response_json = response.json()
-        if response.status_code == 200:
+        self.status_cache.invalidate()
+        return result
+
+    async def fetch_server_status(self):
+        logger.debug("Getting Server Status")
+        status_code, response_json = await self.request("GET", "")
+        if status_code == 200:
             status = response_json["data"]["gameserver"]["status"]
             if status in self.status_codes:
                 status = self.status_codes[status]
@@ -51,33 +211,27 @@ class NitradoApi:
         return status
 
     async def stop_server(self):
-        print("Stopping Server")
-        response = requests.post(
-            f"https://api.nitrado.net/services/{self.SERVER_ID}/gameservers/stop",
-            auth=BearerAuth(self.NITRADO_TOKEN),
-        )
-        print("Status Code: " + str(response.status_code))
-        print("Response: " + str(response.content))
-        response_json = response.json()
+        logger.info("Stopping Server")
+        status_code, response_json = await self.request("POST", "/stop")
+        self.status_cache.invalidate()
         status = response_json["message"]
         return status
 
+    async def force_stop_server(self):
+        return await self.stop_server()
+
     async def start_server(self, game="arksa"):
-        print("Starting Server for " + game)
+        logger.info("Starting Server for %s", game)
         payload = {"game": game}
-        response = requests.post(
-            f"https://api.nitrado.net/services/{self.SERVER_ID}/gameservers/games/start",
-            auth=BearerAuth(self.NITRADO_TOKEN),
-            params=payload,
+        status_code, response_json = await self.request(
+            "POST", "/games/start", params=payload
         )
-        print("Status Code: " + str(response.status_code))
-        print("Response: " + str(response.content))
-        response_json = response.json()
+        self.status_cache.invalidate()
         status = response_json["message"]
         return status
 
     async def safe_start_server(self, game="arksa"):
-        print("Running safe server start")
+        logger.info("Running safe server start")
         server_status = await self.get_server_status()
         if server_status.lower() in ["stopped"]:
             status = await self.start_server(game)
@@ -86,7 +240,7 @@ class NitradoApi:
         return status
 
     async def safe_stop_server(self):
-        print("Running safe server stop")
+        logger.info("Running safe server stop")
         server_status = await self.get_server_status()
         if server_status.lower() in ["started"]:
             status = await self.stop_server()
@@ -95,51 +249,96 @@ class NitradoApi:
         return status
 
     async def uninstall_game(self, game="arksa"):
-        print("Uninstalling game for " + game)
+        logger.info("Uninstalling game for %s", game)
         payload = {"game": game}
-        response = requests.delete(
-            f"https://api.nitrado.net/services/{self.SERVER_ID}/gameservers/games/uninstall",
-            auth=BearerAuth(self.NITRADO_TOKEN),
-            params=payload,
+        status_code, response_json = await self.request(
+            "DELETE", "/games/uninstall", params=payload
         )
-        print("Status Code: " + str(response.status_code))
-        print("Response: " + str(response.content))
-        response_json = response.json()
+        self.status_cache.invalidate()
         status = response_json["message"]
         return status
 
     async def restart_server(
         self, message="Restarting...", restart_message="Restarting..."
     ):
-        print("Restarting Server")
+        logger.info("Restarting Server")
         payload = {"message": message, "restart_message": restart_message}
-        response = requests.post(
-            f"https://api.nitrado.net/services/{self.SERVER_ID}/gameservers/restart",
-            auth=BearerAuth(self.NITRADO_TOKEN),
-            params=payload,
+        status_code, response_json = await self.request(
+            "POST", "/restart", params=payload
         )
-        print("Status Code: " + str(response.status_code))
-        print("Response: " + str(response.content))
-        response_json = response.json()
+        self.status_cache.invalidate()
         status = response_json["message"]
         return status
 
     async def run_console_command(self, command=""):
-        print("Running command on Server: " + command)
-        with Client(self.RCON_IP, self.RCON_PORT, passwd=self.RCON_PWD) as client:
-            try:
-                response = client.run(command)
-            except Exception as e:
-                print(e)
-            else:
-                return response
+        logger.info("Running command on Server: %s", command)
+        try:
+            response = await self.rcon_pool.run(command)
+        except Exception as e:
+            logger.error("Console command failed: %s", e)
+        else:
+            return response
         return None
 
+    async def get_console_log(self, lines=10, search=None):
+        if not self.LOG_FILE:
+            # Tell the user why there is no log rather than failing the command.
+            return "Log file not configured for this server (set NITRADO_LOG_FILE)"
+        return "\n".join(await self.log_tailer.get_lines(lines, search))
+
+    async def fetch_console_log(self, cursor):
+        if not self.LOG_FILE:
+            # A setup problem, retrying it would only count against the circuit breaker.
+            raise BackendError("NITRADO_LOG_FILE is not set", retryable=False)
+        status_code, response_json = await self.request(
+            "GET", "/file_server/download", params={"file": self.LOG_FILE}
+        )
+        if status_code != 200:
+            raise BackendError(response_json.get("message"), status=status_code)
+        url = response_json["data"]["token"]["url"]
+        # The first read only takes the tail of the file, after that only new bytes.
+        if cursor is None:
+            byte_range = f"bytes=-{self.LOG_TAIL_BYTES}"
+        else:
+            byte_range = f"bytes={cursor}-"
+        session = self.get_session()
+        async with session.get(url, headers={"Range": byte_range}) as response:
+            content = await response.read()
+            content_range = response.headers.get("Content-Range", "")
+            status = response.status
+        size = int(content_range.split("/")[-1]) if "/" in content_range else None
+        if status == 416:
+            if size is not None and cursor is not None and size < cursor:
+                # The log was rotated, start again from the top of the new file.
+                return await self.fetch_console_log(0)
+            return [], cursor
+        if status == 200:
+            size = len(content)
+            if cursor is None or size < cursor:
+                start = max(0, size - self.LOG_TAIL_BYTES)
+            else:
+                start = cursor
+            content = content[start:]
+        elif status == 206:
+            start = int(content_range.split(" ")[-1].split("-")[0])
+        else:
+            raise BackendError(
+                f"Log download failed with status {status}", status=status
+            )
+        last_newline = content.rfind(b"\n")
+        if last_newline == -1:
+            return [], start
+        complete = content[: last_newline + 1]
+        lines = complete.decode("utf-8", errors="replace").splitlines()
+        if start > 0 and start != cursor:
+            # A tail read usually starts in the middle of a line.
+            lines = lines[1:]
+        next_cursor = start + len(complete)
+        return [line for line in lines if line.strip()], next_cursor
 
-class BearerAuth(requests.auth.AuthBase):
-    def __init__(self, token):
-        self.token = token
+    async def broadcast(self, message):
+        return await self.run_console_command("ServerChat " + message)
 
-    def __call__(self, r):
-        r.headers["authorization"] = "Bearer " + self.token
-        return r
+    async def run_console_script(self, steps):
+        logger.info("Running console script on Server: %s", steps)
+        return await self.rcon_pool.run_script(steps)
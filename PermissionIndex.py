@@ -0,0 +1,87 @@
+import logging
+from collections import defaultdict
+
+EVERYONE = "*"
+
+
+def parse_role_names(value):
+    return {name.strip() for name in (value or "").split("|") if name.strip()}
+
+
+def parse_command_roles(value):
+    # "start_server=Admin|Mods;get_server_status=*" gives each command its own roles.
+    policies = {}
+    for entry in (value or "").split(";"):
+        if not entry.strip():
+            continue
+        command, _, roles = entry.partition("=")
+        policies[command.strip()] = parse_role_names(roles)
+    return policies
+
+
+class PermissionIndex:
+    def __init__(self, default_roles=None, command_roles=None):
+        self.default_roles = set(default_roles or ())
+        self.command_roles = dict(command_roles or {})
+        self.role_names = set(self.default_roles)
+        for roles in self.command_roles.values():
+            self.role_names |= roles
+        self.role_names.discard(EVERYONE)
+        # (guild id, role name) -> ids of the members holding a role with that name.
+        self.members = defaultdict(set)
+        # guild id -> {role id: role name} for the roles any policy mentions.
+        self.role_ids = {}
+
+    def allowed_roles(self, command):
+        roles = self.command_roles.get(command, self.default_roles)
+        if not roles or EVERYONE in roles:
+            return None
+        return roles
+
+    def index_guild(self, guild):
+        for key in [key for key in self.members if key[0] == guild.id]:
+            del self.members[key]
+        self.role_ids[guild.id] = {
+            role.id: role.name for role in guild.roles if role.name in self.role_names
+        }
+        for role_id, name in self.role_ids[guild.id].items():
+            role = guild.get_role(role_id)
+            self.members[(guild.id, name)].update(member.id for member in role.members)
+        logging.info(
+            f"Indexed roles for guild {guild.id}: "
+            + ", ".join(
+                f"{name}={len(self.members[(guild.id, name)])}"
+                for name in self.role_ids[guild.id].values()
+            )
+        )
+
+    def forget_guild(self, guild_id):
+        self.role_ids.pop(guild_id, None)
+        for key in [key for key in self.members if key[0] == guild_id]:
+            del self.members[key]
+
+    def update_member(self, member):
+        role_ids = self.role_ids.get(member.guild.id)
+        if role_ids is None:
+            return
+        held = {role_ids[role.id] for role in member.roles if role.id in role_ids}
+        for name in set(role_ids.values()):
+            if name in held:
+                self.members[(member.guild.id, name)].add(member.id)
+            else:
+                self.members[(member.guild.id, name)].discard(member.id)
+
+    def remove_member(self, guild_id, member_id):
+        for name in set(self.role_ids.get(guild_id, {}).values()):
+            self.members[(guild_id, name)].discard(member_id)
+
+    def is_allowed(self, command, guild_id, member):
+        roles = self.allowed_roles(command)
+        if roles is None:
+            return True
+        if guild_id is None:
+            return False
+        if guild_id not in self.role_ids:
+            # The guild has not been indexed yet, so go by the member's own roles.
+            return any(role.name in roles for role in getattr(member, "roles", []))
+        return any(member.id in self.members[(guild_id, name)] for name in roles)
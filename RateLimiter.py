@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+# Requests made from a user's command go first, polling marks itself as background.
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_USER)
+
+
+@contextmanager
+def background_priority():
+    token = request_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class RateLimiter:
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.remaining = None
+        self.limit = None
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.condition = asyncio.Condition()
+        self.throttled = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_delay(self):
+        self.refill()
+        delay = max(0, self.blocked_until - time.monotonic())
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    async def acquire(self, priority=None):
+        if priority is None:
+            priority = request_priority.get()
+        entry = (priority, next(self.sequence))
+        async with self.condition:
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    delay = self.get_delay()
+                    if self.waiters[0] == entry and delay <= 0:
+                        heapq.heappop(self.waiters)
+                        self.tokens -= 1
+                        self.condition.notify_all()
+                        return
+                    if self.waiters[0] == entry:
+                        self.throttled += 1
+                        logging.debug(f"{self.name} rate limited for {delay:.1f}s")
+                    else:
+                        # Only the head of the queue needs a timer, the rest are woken by it.
+                        delay = None
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+                raise
+
+    def update_from_headers(self, headers):
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if limit is not None and limit.isdigit():
+            self.limit = int(limit)
+        if remaining is None or not remaining.isdigit():
+            return
+        self.remaining = int(remaining)
+        self.refill()
+        # The server's count wins over ours, it also sees other clients on the token.
+        self.tokens = min(self.tokens, self.remaining)
+        if self.remaining == 0 and reset is not None and reset.isdigit():
+            self.block_for(int(reset) - time.time())
+        logging.debug(f"{self.name} rate limit budget: {self.budget()}")
+
+    def block_for(self, seconds):
+        seconds = max(0, seconds)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        logging.warning(f"{self.name} rate limit reached, pausing for {seconds:.0f}s")
+
+    def budget(self):
+        self.refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "remaining": self.remaining,
+            "limit": self.limit,
+            "waiting": len(self.waiters),
+            "throttled": self.throttled,
+        }
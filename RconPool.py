@@ -0,0 +1,222 @@
+import asyncio
+import itertools
+import logging
+import struct
+
+from Metrics import Histogram
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+ROUND_TRIP_SECONDS = Histogram(
+    "rcon_round_trip_seconds", "RCON command round-trip time", ["host", "outcome"]
+)
+
+
+class RconError(Exception):
+    pass
+
+
+class RconConnection:
+    def __init__(self, host, port, password, timeout=10, encoding="utf-8"):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.encoding = encoding
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.pending = {}
+        # Responses can span several packets, so parts are collected per command
+        # until the empty packet sent after it comes back.
+        self.parts = {}
+        self.terminators = {}
+        self.auth_future = None
+        self.ids = itertools.count(1)
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    @property
+    def load(self):
+        return len(self.pending)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        self.read_task = asyncio.ensure_future(self.read_loop())
+        self.auth_future = asyncio.get_running_loop().create_future()
+        self.send_packet(next(self.ids), SERVERDATA_AUTH, self.password)
+        try:
+            await asyncio.wait_for(self.auth_future, self.timeout)
+        except BaseException:
+            await self.close()
+            raise
+        logging.debug(f"RCON connected to {self.host}:{self.port}")
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            self.read_task.cancel()
+        self.fail_pending(RconError("RCON connection closed"))
+        self.writer = None
+        self.read_task = None
+
+    def send_packet(self, packet_id, packet_type, body):
+        payload = struct.pack("<ii", packet_id, packet_type)
+        payload += body.encode(self.encoding) + b"\x00\x00"
+        self.writer.write(struct.pack("<i", len(payload)) + payload)
+
+    async def read_loop(self):
+        try:
+            while True:
+                size = struct.unpack("<i", await self.reader.readexactly(4))[0]
+                data = await self.reader.readexactly(size)
+                packet_id, packet_type = struct.unpack("<ii", data[:8])
+                body = data[8:-2].decode(self.encoding, errors="replace")
+                self.dispatch(packet_id, packet_type, body)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logging.debug(f"RCON connection dropped: {err}")
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+            self.writer = None
+            self.fail_pending(RconError("RCON connection dropped"))
+
+    def dispatch(self, packet_id, packet_type, body):
+        if self.auth_future is not None and not self.auth_future.done():
+            # Source servers send an empty response value ahead of the auth response.
+            if packet_type != SERVERDATA_AUTH_RESPONSE:
+                return
+            if packet_id == -1:
+                self.auth_future.set_exception(RconError("RCON authentication failed"))
+            else:
+                self.auth_future.set_result(True)
+            return
+        if packet_id in self.parts:
+            self.parts[packet_id].append(body)
+            return
+        command_id = self.terminators.pop(packet_id, None)
+        if command_id is None:
+            # Source servers answer the terminator twice, the second one is dropped here.
+            return
+        future = self.pending.pop(command_id, None)
+        body = "".join(self.parts.pop(command_id, []))
+        if future is not None and not future.done():
+            future.set_result(body)
+
+    def fail_pending(self, err):
+        if self.auth_future is not None and not self.auth_future.done():
+            self.auth_future.set_exception(err)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(err)
+        self.pending.clear()
+        self.parts.clear()
+        self.terminators.clear()
+
+    async def run(self, command):
+        if not self.connected:
+            raise RconError("RCON connection is not open")
+        packet_id = next(self.ids)
+        terminator_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[packet_id] = future
+        self.parts[packet_id] = []
+        self.terminators[terminator_id] = packet_id
+        self.send_packet(packet_id, SERVERDATA_EXECCOMMAND, command)
+        # The server answers in order, so the echo of this empty packet marks the
+        # end of the command's response.
+        self.send_packet(terminator_id, SERVERDATA_RESPONSE_VALUE, "")
+        with ROUND_TRIP_SECONDS.time(host=self.host, outcome="error") as labels:
+            try:
+                await self.writer.drain()
+                response = await asyncio.wait_for(future, self.timeout)
+            finally:
+                self.pending.pop(packet_id, None)
+                self.parts.pop(packet_id, None)
+                self.terminators.pop(terminator_id, None)
+            labels["outcome"] = "ok"
+            return response
+
+
+class RconPool:
+    def __init__(self, host, port, password, max_size=2, timeout=10):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connections = []
+        self.lock = asyncio.Lock()
+
+    async def get_connection(self):
+        async with self.lock:
+            self.connections = [conn for conn in self.connections if conn.connected]
+            idle = [conn for conn in self.connections if conn.load == 0]
+            if idle:
+                return idle[0]
+            if len(self.connections) < self.max_size:
+                conn = RconConnection(
+                    self.host, self.port, self.password, timeout=self.timeout
+                )
+                await conn.connect()
+                self.connections.append(conn)
+                return conn
+            # Pool is full, so share the least busy connection; replies are matched by id.
+            return min(self.connections, key=lambda conn: conn.load)
+
+    async def run(self, command):
+        conn = await self.get_connection()
+        try:
+            return await conn.run(command)
+        except RconError:
+            # The connection went away under us, retry once on a fresh one.
+            logging.info("RCON connection lost, reconnecting")
+            await conn.close()
+            conn = await self.get_connection()
+            return await conn.run(command)
+
+    async def run_script(self, steps):
+        results = []
+        conn = await self.get_connection()
+        batch = []
+        for command, delay in steps:
+            batch.append(command)
+            if delay:
+                if not await self.run_batch(conn, batch, results):
+                    return results
+                batch = []
+                await asyncio.sleep(delay)
+        await self.run_batch(conn, batch, results)
+        return results
+
+    async def run_batch(self, conn, commands, results):
+        # Commands without a delay between them are pipelined on the same connection.
+        responses = await asyncio.gather(
+            *[conn.run(command) for command in commands], return_exceptions=True
+        )
+        for command, response in zip(commands, responses):
+            if isinstance(response, (RconError, asyncio.TimeoutError)):
+                # Steps are not idempotent, so stop here rather than replaying the script.
+                logging.info(f"RCON script stopped at {command}: {response}")
+                results.append((command, f"Error: {response}"))
+                return False
+            if isinstance(response, BaseException):
+                raise response
+            results.append((command, response))
+        return True
+
+    async def close(self):
+        async with self.lock:
+            for conn in self.connections:
+                await conn.close()
+            self.connections = []
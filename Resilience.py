@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+
+import aiohttp
+
+
+class BackendError(Exception):
+    def __init__(self, message, status=None, retry_after=None, retryable=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+        self.is_retryable = retryable
+
+    def __reduce__(self):
+        # Keeps status and retry_after when the error comes back from a worker process.
+        return (
+            type(self),
+            (self.message, self.status, self.retry_after, self.is_retryable),
+        )
+
+    @property
+    def retryable(self):
+        if self.is_retryable is not None:
+            return self.is_retryable
+        if self.status is None:
+            return True
+        return self.status == 429 or self.status >= 500
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60, failure_errors=()):
+        self.name = name
+        # Backend specific exceptions that also mean the backend is in trouble.
+        self.failure_errors = tuple(failure_errors)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    f"{self.name} is unavailable, not sending requests for now"
+                )
+            logging.info(f"Circuit {self.name} half open, trying one request")
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            # Only the trial request goes out, everyone else fails fast until it settles.
+            if self.probing:
+                raise CircuitOpenError(
+                    f"{self.name} is being retried, not sending requests for now"
+                )
+            self.probing = True
+
+    def release(self):
+        # The trial ended without saying anything about the backend, let another try.
+        self.probing = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info(f"Circuit {self.name} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(
+                    f"Circuit {self.name} opened after {self.failures} failures"
+                )
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    def __init__(self, max_tries=2, base_delay=1.0, max_delay=30.0):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = Counter()
+
+    def get_delay(self, attempt, err=None):
+        if isinstance(err, BackendError) and err.retry_after is not None:
+            return min(err.retry_after, self.max_delay)
+        # Full jitter keeps callers that failed together from retrying together.
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def is_retryable(self, err):
+        if isinstance(err, CircuitOpenError):
+            return False
+        if isinstance(err, BackendError):
+            return err.retryable
+        if isinstance(err, aiohttp.ClientResponseError):
+            return err.status == 429 or err.status >= 500
+        if isinstance(err, (asyncio.TimeoutError, aiohttp.ClientError, OSError)):
+            return True
+        if isinstance(err, (TypeError, ValueError, KeyError, AttributeError)):
+            return False
+        return True
+
+    def counts_against_breaker(self, err, breaker):
+        # Only errors that say the backend is struggling open the circuit, a bug or an
+        # unexpected exception in our own code should not take the backend offline.
+        if isinstance(err, breaker.failure_errors):
+            return True
+        if isinstance(err, BackendError):
+            return err.retryable
+        if isinstance(err, aiohttp.ClientResponseError):
+            return err.status == 429 or err.status >= 500
+        return isinstance(err, (asyncio.TimeoutError, aiohttp.ClientError, OSError))
+
+    def before_attempt(self, func, breaker):
+        if breaker is not None:
+            breaker.before_call()
+        self.counters["attempts"] += 1
+
+    def on_success(self, breaker):
+        self.counters["successes"] += 1
+        if breaker is not None:
+            breaker.record_success()
+
+    def on_failure(self, func, err, attempt, max_tries, breaker):
+        self.counters["failures"] += 1
+        if isinstance(err, CircuitOpenError):
+            raise err
+        if breaker is not None:
+            if self.counts_against_breaker(err, breaker):
+                breaker.record_failure()
+            else:
+                breaker.release()
+        if not self.is_retryable(err):
+            logging.info(f"Not retrying {func}: {err}")
+            raise err
+        if attempt >= max_tries:
+            logging.info(f"Max retries reached: {func}")
+            raise err
+        self.counters["retries"] += 1
+        delay = self.get_delay(attempt, err)
+        logging.exception("Exception occurred: %s", err)
+        logging.info(f"Retrying Last Function call in {delay:.1f}s: {func}")
+        return delay
+
+    async def run_async(self, func, *args, max_tries=None, breaker=None):
+        max_tries = max_tries or self.max_tries
+        attempt = 0
+        while True:
+            attempt += 1
+            self.before_attempt(func, breaker)
+            try:
+                result = await func(*args)
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.release()
+                raise
+            except Exception as err:
+                delay = self.on_failure(func, err, attempt, max_tries, breaker)
+                await asyncio.sleep(delay)
+                continue
+            self.on_success(breaker)
+            return result
+
+    def run(self, func, *args, max_tries=None, breaker=None):
+        max_tries = max_tries or self.max_tries
+        attempt = 0
+        while True:
+            attempt += 1
+            self.before_attempt(func, breaker)
+            try:
+                result = func(*args)
+            except Exception as err:
+                delay = self.on_failure(func, err, attempt, max_tries, breaker)
+                time.sleep(delay)
+                continue
+            self.on_success(breaker)
+            return result
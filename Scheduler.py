@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import sqlite3
+import time
+
+WARNING_MINUTES = (10, 5, 1)
+MISSED_GRACE = 15 * 60
+
+
+class ScheduledJob:
+    def __init__(self, job_id, action, run_at, channel_id, requested_by, server=None):
+        self.job_id = job_id
+        self.action = action
+        self.run_at = run_at
+        self.channel_id = channel_id
+        self.requested_by = requested_by
+        self.server = server
+
+    def minutes_left(self):
+        return max(0, round((self.run_at - time.time()) / 60))
+
+
+class Scheduler:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.run_job = None
+        self.warn_job = None
+        self.jobs = {}
+        self.timers = []
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.db = sqlite3.connect(db_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "action TEXT NOT NULL, "
+            "run_at REAL NOT NULL, "
+            "channel_id INTEGER, "
+            "requested_by TEXT, "
+            "status TEXT NOT NULL DEFAULT 'pending')"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "server" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN server TEXT")
+        self.db.commit()
+
+    def start(self, run_job, warn_job):
+        if self.task is not None:
+            return
+        self.run_job = run_job
+        self.warn_job = warn_job
+        rows = self.db.execute(
+            "SELECT id, action, run_at, channel_id, requested_by, server FROM jobs "
+            "WHERE status = 'pending' ORDER BY run_at"
+        ).fetchall()
+        for row in rows:
+            job = ScheduledJob(*row)
+            if job.run_at < time.time() - MISSED_GRACE:
+                # Too late to act on something that was due while the bot was down.
+                logging.info(f"Skipping missed scheduled job {job.job_id}")
+                self.set_status(job.job_id, "missed")
+                continue
+            self.add_timers(job)
+        logging.info(f"Rehydrated {len(self.jobs)} scheduled jobs")
+        self.task = asyncio.ensure_future(self.run())
+
+    def schedule(self, action, minutes, channel_id, requested_by, server=None):
+        run_at = time.time() + 60 * minutes
+        existing = self.find_pending(action, server)
+        if existing is not None and action == "stop":
+            # Overlapping stop requests collapse into the earliest one.
+            if existing.run_at <= run_at:
+                return existing, False
+            self.cancel(existing.job_id)
+        cursor = self.db.execute(
+            "INSERT INTO jobs (action, run_at, channel_id, requested_by, server) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (action, run_at, channel_id, requested_by, server),
+        )
+        self.db.commit()
+        job = ScheduledJob(
+            cursor.lastrowid, action, run_at, channel_id, requested_by, server
+        )
+        self.add_timers(job)
+        return job, True
+
+    def cancel(self, job_id):
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return None
+        # Its timers stay in the heap and are skipped when they come up.
+        self.set_status(job_id, "cancelled")
+        self.wakeup.set()
+        return job
+
+    def list_jobs(self):
+        return sorted(self.jobs.values(), key=lambda job: job.run_at)
+
+    def find_pending(self, action, server=None):
+        for job in self.list_jobs():
+            if job.action == action and job.server == server:
+                return job
+        return None
+
+    def add_timers(self, job):
+        self.jobs[job.job_id] = job
+        now = time.time()
+        for minutes in WARNING_MINUTES:
+            warn_at = job.run_at - 60 * minutes
+            if warn_at > now:
+                self.push(warn_at, job.job_id, minutes)
+        self.push(job.run_at, job.job_id, 0)
+        self.wakeup.set()
+
+    def push(self, when, job_id, minutes):
+        heapq.heappush(self.timers, (when, next(self.sequence), job_id, minutes))
+
+    def set_status(self, job_id, status):
+        self.db.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+        self.db.commit()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.timers:
+                await self.wakeup.wait()
+                continue
+            when, _, job_id, minutes = self.timers[0]
+            delay = when - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.timers)
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if minutes:
+                asyncio.ensure_future(self.fire(self.warn_job, job, minutes))
+            else:
+                del self.jobs[job_id]
+                self.set_status(job_id, "done")
+                asyncio.ensure_future(self.fire(self.run_job, job))
+
+    async def fire(self, callback, job, *args):
+        try:
+            await callback(job, *args)
+        except Exception as err:
+            logging.exception(f"Scheduled job {job.job_id} failed: {err}")
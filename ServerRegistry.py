@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+
+DEFAULT_SERVER_NAME = "default"
+# Without these an entry would quietly fall back to the env settings of another server.
+REQUIRED_KEYS = {
+    "nitrado": ["server_id", "rcon_address", "rcon_password"],
+    "apex": [],
+}
+
+
+def resolve_value(value):
+    # Secrets can stay in the environment: "env:NAME" is replaced by $NAME.
+    if isinstance(value, str) and value.startswith("env:"):
+        return os.getenv(value[4:])
+    return value
+
+
+def check_config(config):
+    name = config.get("name")
+    if not name:
+        raise ValueError("Every server in the servers file needs a name")
+    backend_type = config.get("backend", "nitrado")
+    if backend_type not in REQUIRED_KEYS:
+        raise ValueError(f"Unknown server backend for {name}: {backend_type}")
+    missing = [key for key in REQUIRED_KEYS[backend_type] if not config.get(key)]
+    if missing:
+        raise ValueError(f"Server {name} is missing {', '.join(missing)}")
+    if backend_type == "apex" and not config.get("session_file"):
+        # Servers sharing one session file would keep overwriting each other's cookies.
+        root, ext = os.path.splitext(os.getenv("APH_SESSION_FILE", "apex_session.json"))
+        config["session_file"] = f"{root}_{name}{ext}"
+    return config
+
+
+def create_backend(config):
+    backend_type = config.get("backend", "nitrado")
+    if backend_type == "nitrado":
+        from NitradoApi import NitradoApi
+
+        return NitradoApi(
+            server_id=config.get("server_id"),
+            token=config.get("token"),
+            rcon_address=config.get("rcon_address"),
+            rcon_password=config.get("rcon_password"),
+            log_file=config.get("log_file"),
+        )
+    if backend_type == "apex":
+        from ApexHostingApi import ApexHostingApi
+
+        return ApexHostingApi(
+            headless=config.get("headless", True),
+            min_timeout=config.get("min_timeout", 10),
+            max_timeout=config.get("max_timeout", 15),
+            username=config.get("username"),
+            password=config.get("password"),
+            session_file=config.get("session_file"),
+        )
+    raise ValueError(f"Unknown server backend: {backend_type}")
+
+
+def create_rate_limiter(config):
+    # Worker processes draw on the gateway's limiter, so servers sharing a token keep
+    # sharing one budget however they are run.
+    if config.get("backend", "nitrado") != "nitrado":
+        return None
+    from NitradoApi import get_rate_limiter
+
+    server_id = config.get("server_id") or os.getenv("SERVER_ID")
+    return get_rate_limiter(
+        config.get("token") or os.getenv("NITRADO_TOKEN"), f"nitrado:{server_id}"
+    )
+
+
+class ServerRegistry:
+    def __init__(self, path=None):
+        self.path = path or os.getenv("SERVERS_FILE", "servers.json")
+        self.configs = {}
+        self.backends = {}
+        self.default_name = None
+        # "process" runs each backend in its own worker process, away from the gateway.
+        self.worker_mode = os.getenv("BACKEND_WORKERS", "inline").lower() == "process"
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as servers_file:
+                data = json.load(servers_file)
+            for server in data["servers"]:
+                config = {key: resolve_value(value) for key, value in server.items()}
+                check_config(config)
+                self.configs[config["name"]] = config
+            self.default_name = data.get("default", next(iter(self.configs)))
+        else:
+            # Without a servers file the bot keeps working off the old env settings.
+            self.configs[DEFAULT_SERVER_NAME] = {
+                "name": DEFAULT_SERVER_NAME,
+                "backend": os.getenv("SERVER_BACKEND", "nitrado"),
+            }
+            self.default_name = DEFAULT_SERVER_NAME
+        logging.info(f"Loaded servers: {', '.join(self.configs)}")
+
+    def names(self):
+        return list(self.configs)
+
+    def resolve_name(self, name=None):
+        name = name or self.default_name
+        return name if name in self.configs else None
+
+    def get(self, name=None):
+        name = self.resolve_name(name)
+        if name is None:
+            return None
+        # Backends are only imported and built once a command needs them.
+        if name not in self.backends:
+            logging.info(f"Starting backend for server {name}")
+            if self.worker_mode:
+                from BackendWorker import RemoteBackend
+
+                self.backends[name] = RemoteBackend(
+                    name,
+                    self.configs[name],
+                    rate_limiter=create_rate_limiter(self.configs[name]),
+                    ping_interval=float(os.getenv("WORKER_PING_INTERVAL", 15)),
+                )
+            else:
+                self.backends[name] = create_backend(self.configs[name])
+        return self.backends[name]
+
+    def items(self):
+        return [(name, self.get(name)) for name in self.names()]
+
+    def loaded_items(self):
+        return list(self.backends.items())
+
+    async def close(self):
+        for backend in self.backends.values():
+            await backend.close()
+        self.backends = {}
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import time
+
+
+class StatusCache:
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self.value = None
+        self.fetched_at = 0
+        self.generation = 0
+        self.in_flight = None
+
+    def invalidate(self):
+        self.value = None
+        self.fetched_at = 0
+        # Anything already in flight was sent before the command, so its answer is stale.
+        self.generation += 1
+        self.in_flight = None
+
+    async def get(self, fetch):
+        if self.value is not None and time.monotonic() - self.fetched_at < self.ttl:
+            logging.debug("Serving server status from cache")
+            return self.value
+        if self.in_flight is None:
+            self.in_flight = asyncio.ensure_future(self.refresh(fetch, self.generation))
+        # Shielded so one caller giving up does not cancel the request for everyone else.
+        return await asyncio.shield(self.in_flight)
+
+    async def refresh(self, fetch, generation):
+        try:
+            value = await fetch()
+        finally:
+            if self.generation == generation:
+                self.in_flight = None
+        if self.generation == generation:
+            self.value = value
+            self.fetched_at = time.monotonic()
+        return value
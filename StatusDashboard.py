@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from RateLimiter import PRIORITY_BACKGROUND, request_priority
+
+DASHBOARD_TITLE = "## Server Dashboard"
+
+
+class ServerState:
+    def __init__(self, name, get_status, transitional_statuses):
+        self.name = name
+        self.get_status = get_status
+        self.transitional_statuses = transitional_statuses
+        self.status = None
+        self.changed_at = None
+        self.errors = 0
+
+    @property
+    def transitional(self):
+        if self.status is None:
+            return False
+        # Read on every check, a worker backend only fills these in once it is up.
+        return self.status.lower() in {
+            status.lower() for status in self.transitional_statuses
+        }
+
+
+class StatusDashboard:
+    def __init__(
+        self,
+        servers,
+        format_time,
+        fast_interval=10,
+        slow_interval=120,
+        max_interval=600,
+    ):
+        self.servers = [
+            ServerState(name, get_status, transitional_statuses)
+            for name, get_status, transitional_statuses in servers
+        ]
+        self.format_time = format_time
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.max_interval = max_interval
+        self.task = None
+
+    def start(self, channel):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run(channel))
+
+    async def find_message(self, channel):
+        for message in await channel.pins():
+            if message.author == channel.guild.me and message.content.startswith(
+                DASHBOARD_TITLE
+            ):
+                return message
+        message = await channel.send(self.render())
+        try:
+            await message.pin()
+        except discord.HTTPException as err:
+            logging.error(f"Could not pin the dashboard message: {err}")
+        return message
+
+    def render(self):
+        lines = []
+        for server in self.servers:
+            if server.status is None:
+                line = f"{server.name}: Unknown"
+            else:
+                line = (
+                    f"{server.name}: {server.status} "
+                    f"(since {self.format_time(server.changed_at)})"
+                )
+            if server.errors:
+                line += " - API not responding, showing last known status"
+            lines.append(line)
+        body = "\n".join(lines)
+        return f"{DASHBOARD_TITLE}\n```{body}```"
+
+    def next_interval(self):
+        if any(server.transitional for server in self.servers):
+            interval = self.fast_interval
+        else:
+            interval = self.slow_interval
+        # Back off while the API is failing so we do not add to its load.
+        errors = min(server.errors for server in self.servers)
+        return min(self.max_interval, interval * 2**errors)
+
+    async def poll(self, server):
+        try:
+            status = await server.get_status()
+        except Exception as err:
+            server.errors += 1
+            logging.error(f"Dashboard status poll for {server.name} failed: {err}")
+            return
+        server.errors = 0
+        if status != server.status:
+            server.status = status
+            server.changed_at = time.time()
+
+    async def run(self, channel):
+        # Dashboard polls wait behind anything a user asked for.
+        request_priority.set(PRIORITY_BACKGROUND)
+        message = None
+        content = None
+        failures = 0
+        while True:
+            try:
+                if message is None:
+                    message = await self.find_message(channel)
+                    content = message.content
+                await asyncio.gather(*[self.poll(server) for server in self.servers])
+                rendered = self.render()
+                # Only touch Discord when something the reader can see has changed.
+                if rendered != content:
+                    try:
+                        message = await message.edit(content=rendered)
+                        content = rendered
+                    except discord.NotFound:
+                        message = None
+                failures = 0
+                interval = self.next_interval()
+            except Exception:
+                # Keep the dashboard alive through Discord errors, just try again later.
+                failures += 1
+                logging.exception("Dashboard update failed")
+                interval = min(self.max_interval, self.fast_interval * 2**failures)
+            await asyncio.sleep(interval)
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+
+from Metrics import Histogram
+from RateLimiter import background_priority
+
+# Servers take minutes to start or stop, well past the default buckets.
+TRANSITION_SECONDS = Histogram(
+    "server_transition_seconds",
+    "Time for a server to reach the status an action asked for",
+    ["action"],
+    buckets=(5, 10, 30, 60, 120, 300, 600),
+)
+
+
+class TransitionStats:
+    def __init__(self, max_samples=50):
+        self.durations = defaultdict(lambda: deque(maxlen=max_samples))
+
+    def record(self, action, seconds):
+        self.durations[action].append(seconds)
+        TRANSITION_SECONDS.observe(seconds, action=action)
+        logging.info(f"Server {action} took {seconds:.0f}s")
+
+    def average(self, action):
+        durations = self.durations.get(action)
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+
+async def wait_for_status(
+    fetch,
+    targets,
+    timeout=600,
+    on_progress=None,
+    require_change=False,
+    initial_delay=2,
+    max_delay=15,
+):
+    targets = {target.lower() for target in targets}
+    start = time.monotonic()
+    delay = initial_delay
+    seen = []
+    while True:
+        try:
+            with background_priority():
+                status = await fetch()
+        except Exception as err:
+            logging.debug(f"Status poll failed while waiting: {err}")
+            status = None
+        if status is not None and (not seen or seen[-1] != status):
+            seen.append(status)
+            if on_progress is not None:
+                await on_progress(seen, time.monotonic() - start)
+        # A restart starts and ends on the same status, so it must be seen to leave first.
+        changed = not require_change or len(seen) > 1
+        if status is not None and status.lower() in targets and changed:
+            return status, time.monotonic() - start, seen
+        if time.monotonic() - start + delay > timeout:
+            return status, time.monotonic() - start, seen
+        await asyncio.sleep(delay)
+        delay = min(max_delay, delay * 1.5)
+
+
+class StatusTracker:
+    # One status wait per transition, followed by everyone who asked for it.
+    def __init__(self, wait):
+        self.listeners = []
+        self.seen = []
+        self.elapsed = 0
+        self.task = asyncio.ensure_future(wait(self.publish))
+
+    async def publish(self, seen, elapsed):
+        self.seen = list(seen)
+        self.elapsed = elapsed
+        for listener in list(self.listeners):
+            try:
+                await listener(self.seen, elapsed)
+            except Exception as err:
+                logging.error(f"Status progress update failed: {err}")
+
+    async def follow(self, on_progress=None):
+        if on_progress is not None:
+            self.listeners.append(on_progress)
+            # Someone joining late starts from what has been seen so far.
+            if self.seen and not self.task.done():
+                await on_progress(self.seen, self.elapsed)
+        try:
+            return await asyncio.shield(self.task)
+        finally:
+            if on_progress in self.listeners:
+                self.listeners.remove(on_progress)
@@ -1,108 +1,291 @@
 import asyncio
 import os
 import logging
+import math
 import time
 import pytz
 from datetime import datetime, timezone
-from datetime import timedelta
 
 import discord
 from typing import Optional
 from dotenv import load_dotenv
 
-#from ApexHostingApi import ApexHostingApi
-from NitradoApi import NitradoApi
+from CommandActor import CommandActor, CommandRejected
+from CommandSync import CommandSyncCache
+from ConsoleScript import load_macros, parse_console_script
+from LogSetup import setup_logging
+from Metrics import Counter, Gauge, Histogram, MetricsServer, registry as metrics
+from PermissionIndex import PermissionIndex, parse_command_roles, parse_role_names
+from Resilience import RetryPolicy
+from Scheduler import Scheduler
+from ServerRegistry import ServerRegistry
+from StatusDashboard import StatusDashboard
 
 load_dotenv()
 
 SERVER_ID = os.getenv("SERVER_ID")
 CHANNEL_NAME = os.getenv("CHANNEL_NAME")
 MAX_RETRIES = int(os.getenv("MAX_RETRIES"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 30))
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 LOG_LEVEL = os.getenv("LOG_LEVEL")
 ROLE_NAME = os.getenv("ROLE_NAME")
+COMMAND_ROLES = os.getenv("COMMAND_ROLES")
+STATUS_WAIT_TIMEOUT = int(os.getenv("STATUS_WAIT_TIMEOUT", 600))
+DASHBOARD_ENABLED = os.getenv("DASHBOARD_ENABLED", "false").lower() == "true"
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", 4))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", 80))
+FAST_START = os.getenv("FAST_START", "true").lower() == "true"
 ERROR_MESSAGE = "Sorry, I could not process this request! :("
-FIRST_RESPONSE_MESSAGE = "Request received! :)"
-
-
-aph = None  # ApexHostingApi(headless=True, min_timeout=10, max_timeout=15)
-napi = NitradoApi()
-logging.basicConfig(
-    format="%(asctime)s: [%(levelname)s] %(message)s",
-    level=int(LOG_LEVEL),
-    handlers=[logging.FileHandler("discord.log"), logging.StreamHandler()],
+# Discord wants the first response within 3 s of the interaction being created, and
+# gateway delivery plus the defer round trip come out of that, so never wait longer.
+DEFER_AFTER = min(max(float(os.getenv("DEFER_AFTER", 1)), 0), 1)
+MAX_MESSAGE_LENGTH = 1900
+
+
+setup_logging(
+    level=LOG_LEVEL,
+    log_file=os.getenv("LOG_FILE", "discord.log"),
+    json_format=os.getenv("LOG_FORMAT", "text").lower() == "json",
+    max_bytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+    backup_count=int(os.getenv("LOG_BACKUP_COUNT", 5)),
+    rotate_when=os.getenv("LOG_ROTATE_WHEN"),
+)
+registry = ServerRegistry()
+console_macros = load_macros()
+retry_policy = RetryPolicy(
+    max_tries=MAX_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY
 )
 
-USE_NITRADO = True
+SCHEDULED_ACTIONS = {
+    "start": "safe_start_server",
+    "stop": "stop_server",
+    "restart": "restart_server",
+}
+actors = {}
+# Forced commands end in the same state as their plain counterparts.
+TRANSITIONS = {"force_start": "start", "force_stop": "stop"}
+permissions = PermissionIndex(
+    parse_role_names(ROLE_NAME), parse_command_roles(COMMAND_ROLES)
+)
+COMMAND_SECONDS = Histogram(
+    "discord_command_seconds", "Slash command run time", ["command", "outcome"]
+)
+BACKEND_SECONDS = Histogram(
+    "backend_call_seconds",
+    "Backend call time including retries",
+    ["backend", "call", "outcome"],
+)
+SEND_SECONDS = Histogram("discord_send_seconds", "Discord message send time")
+command_started = {}
+scheduler = Scheduler(os.getenv("SCHEDULER_DB", "scheduler.db"))
+dashboard = None
 
 intents = discord.Intents.default()
 intents.members = True
 
 bot = discord.Bot(intents=intents)
-bot.auto_sync_commands = True
+bot.auto_sync_commands = not FAST_START
+command_sync = CommandSyncCache(os.getenv("COMMAND_SYNC_FILE", "command_sync.json"))
+
+
+@bot.event
+async def on_connect():
+    if FAST_START:
+        await command_sync.sync(bot)
+    else:
+        await bot.sync_commands()
 
 
 @bot.event
 async def on_ready():
     logging.info(f"Logged in as {bot.user} (ID: {bot.user.id})")
     logging.info("------")
+    scheduler.start(run_scheduled_job, warn_scheduled_job)
+    if DASHBOARD_ENABLED:
+        start_dashboard()
+    if METRICS_ENABLED:
+        # Last, and on its own, so a port that cannot be bound leaves the bot running.
+        try:
+            await metrics_server.start()
+        except OSError as err:
+            logging.error(f"Could not serve metrics on port {METRICS_PORT}: {err}")
+
+
+@bot.listen()
+async def on_guild_available(guild: discord.Guild):
+    permissions.index_guild(guild)
+
+
+@bot.listen()
+async def on_guild_join(guild: discord.Guild):
+    permissions.index_guild(guild)
+
+
+@bot.listen()
+async def on_guild_remove(guild: discord.Guild):
+    permissions.forget_guild(guild.id)
+
+
+@bot.listen()
+async def on_member_update(before: discord.Member, after: discord.Member):
+    permissions.update_member(after)
+
+
+@bot.listen()
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    permissions.remove_member(payload.guild_id, payload.user.id)
+
+
+@bot.listen()
+async def on_guild_role_create(role: discord.Role):
+    permissions.index_guild(role.guild)
+
+
+@bot.listen()
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    permissions.index_guild(after.guild)
+
+
+@bot.listen()
+async def on_guild_role_delete(role: discord.Role):
+    permissions.index_guild(role.guild)
+
+
+@bot.listen()
+async def on_application_command(ctx: discord.ApplicationContext):
+    command_started[ctx.interaction.id] = time.monotonic()
+
+
+@bot.listen()
+async def on_application_command_completion(ctx: discord.ApplicationContext):
+    observe_command(ctx, "ok")
+
+
+@bot.listen()
+async def on_application_command_error(ctx: discord.ApplicationContext, error):
+    observe_command(ctx, "error")
+
+
+def observe_command(ctx: discord.ApplicationContext, outcome):
+    start = command_started.pop(ctx.interaction.id, None)
+    if start is None:
+        return
+    latency = time.monotonic() - start
+    command = ctx.command.qualified_name
+    COMMAND_SECONDS.observe(latency, command=command, outcome=outcome)
+    logging.info(
+        "Finished %s in %.2fs: %s",
+        command,
+        latency,
+        outcome,
+        extra={"command": command, "user_id": ctx.author.id, "latency": latency},
+    )
+
+
+def collect_bot_metrics():
+    retries = Counter(
+        "retry_events_total", "Backend call attempts and retries", ["event"], register=False
+    )
+    for event, count in retry_policy.counters.items():
+        retries.inc(count, event=event)
+    latency = Gauge(
+        "discord_gateway_latency_seconds", "Gateway heartbeat latency", register=False
+    )
+    if not math.isnan(bot.latency):
+        latency.set(bot.latency)
+    circuits = Gauge(
+        "backend_circuit_open",
+        "1 while the server's circuit breaker is open",
+        ["server"],
+        register=False,
+    )
+    for name, backend in registry.loaded_items():
+        circuits.set(int(backend.circuit_breaker.state == "open"), server=name)
+    return [retries, latency, circuits]
+
+
+def health_check():
+    gateway = bot.is_ready() and not bot.is_closed()
+    servers = {
+        name: backend.circuit_breaker.state
+        for name, backend in registry.loaded_items()
+    }
+    # One unreachable server is reported but does not make the bot unhealthy.
+    reachable = not servers or any(state != "open" for state in servers.values())
+    return gateway and reachable, {"gateway": gateway, "servers": servers}
+
+
+metrics.add_collector(collect_bot_metrics)
+metrics_server = MetricsServer(health_check, port=METRICS_PORT)
+
+
+async def send_message(channel, content):
+    with SEND_SECONDS.time():
+        return await channel.send(content)
+
+
+async def server_autocomplete(ctx: discord.AutocompleteContext):
+    return [name for name in registry.names() if ctx.value.lower() in name.lower()]
+
+
+def server_option():
+    return discord.Option(
+        str,
+        "The server to use. Defaults to the main server",
+        autocomplete=server_autocomplete,
+        default=None,
+    )
 
 
 @bot.command()
-async def get_server_status(interaction: discord.Interaction):
+async def get_server_status(
+    interaction: discord.Interaction, server: server_option() = None
+):
     """Gets Current Server Status"""
-    log_requests(interaction, f"get_server_status")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"get_server_status", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_server_command(backend, backend.get_server_status),
+        format_result=lambda status: f"```Current server status: {status}```",
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.get_server_status)
-    else:
-        command_msg = await run_server_command(aph.get_server_status)
-    if command_msg is not None:
-        command_msg = f"```Current server status: {command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
 
 
 @bot.command()
-async def start_server(interaction: discord.Interaction):
+async def start_server(interaction: discord.Interaction, server: server_option() = None):
     """Starts the server"""
-    log_requests(interaction, f"start_server")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"start_server", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_lifecycle_command(
+            server, backend, "start", backend.safe_start_server
+        ),
+        track_action="start",
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.safe_start_server)
-    else:
-        command_msg = await run_server_command(aph.start_server)
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
 
 
 @bot.command()
-async def stop_server(interaction: discord.Interaction):
+async def stop_server(interaction: discord.Interaction, server: server_option() = None):
     """Stops the server"""
-    log_requests(interaction, f"stop_server")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"stop_server", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_lifecycle_command(
+            server, backend, "stop", backend.safe_stop_server
+        ),
+        track_action="stop",
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.safe_stop_server)
-    else:
-        command_msg = await run_server_command(aph.stop_server)
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
 
 
 @bot.command()
@@ -115,103 +298,174 @@ async def wait_stop_server(
         max_value=30,
         default=15,
     ),
+    server: server_option() = None,
 ):
     """Stops the server after the duration given by the requester"""
-    log_requests(ctx, f"wait_stop_server")
-    await check_request(ctx)
-    await ctx.response.send_message(f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False)
-    if USE_NITRADO:
-        command_msg = await run_server_command(
-            napi.stop_server, interaction=ctx, minutes=minutes
+    log_requests(ctx, f"wait_stop_server", server)
+    if not await check_request(ctx):
+        return
+    command_msg = schedule_server_action("stop", minutes, ctx, server)
+    await reply(ctx, f"```{command_msg}```")
+
+
+@bot.command()
+async def schedule_server_command(
+    ctx,
+    action: discord.Option(
+        str, "The command to run", choices=list(SCHEDULED_ACTIONS.keys())
+    ),
+    minutes: discord.Option(
+        int,
+        "The minutes to wait before running the command. Min: 1 Max: 1440",
+        min_value=1,
+        max_value=1440,
+    ),
+    server: server_option() = None,
+):
+    """Runs a start, stop or restart after the duration given by the requester"""
+    log_requests(
+        ctx, f"schedule_server_command [action={action}, minutes={minutes}]", server
+    )
+    if not await check_request(ctx):
+        return
+    command_msg = schedule_server_action(action, minutes, ctx, server)
+    await reply(ctx, f"```{command_msg}```")
+
+
+@bot.command()
+async def list_scheduled(ctx):
+    """Lists the scheduled server commands"""
+    log_requests(ctx, f"list_scheduled")
+    if not await check_request(ctx):
+        return
+    jobs = scheduler.list_jobs()
+    if jobs:
+        command_msg = "\n".join(
+            f"#{job.job_id}: {job.action} {job.server or registry.default_name} "
+            f"at {format_time(job.run_at)} (requested by {job.requested_by})"
+            for job in jobs
         )
     else:
-        command_msg = await run_server_command(
-            aph.stop_server, interaction=ctx, minutes=minutes
-        )
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
+        command_msg = "Nothing is scheduled"
+    await reply(ctx, f"```{command_msg}```")
+
+
+@bot.command()
+async def cancel_scheduled(
+    ctx,
+    job_id: discord.Option(int, "The id of the scheduled command from /list_scheduled"),
+):
+    """Cancels a scheduled server command"""
+    log_requests(ctx, f"cancel_scheduled [job_id={job_id}]")
+    if not await check_request(ctx):
+        return
+    job = scheduler.cancel(job_id)
+    if job is not None:
+        command_msg = f"Cancelled scheduled {job.action} #{job.job_id}"
     else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await ctx.channel.send(command_msg)
+        command_msg = f"There is no scheduled command #{job_id}"
+    await reply(ctx, f"```{command_msg}```")
 
 
 @bot.command()
-async def restart_server(interaction: discord.Interaction):
+async def restart_server(
+    interaction: discord.Interaction, server: server_option() = None
+):
     """Restarts the server"""
-    log_requests(interaction, f"restart_server")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"restart_server", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_lifecycle_command(
+            server, backend, "restart", backend.restart_server
+        ),
+        track_action="restart",
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.restart_server)
-    else:
-        command_msg = await run_server_command(aph.restart_server)
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
 
 
 @bot.command()
-async def force_start_server(interaction: discord.Interaction):
+async def force_start_server(
+    interaction: discord.Interaction, server: server_option() = None
+):
     """Force starts the server"""
-    log_requests(interaction, f"force_start_server")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"force_start_server", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_lifecycle_command(
+            server, backend, "force_start", backend.start_server
+        ),
+        track_action="force_start",
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.start_server)
-    else:
-        command_msg = await run_server_command(aph.start_server)
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
 
 
 @bot.command()
-async def force_stop_server(interaction: discord.Interaction):
+async def force_stop_server(
+    interaction: discord.Interaction, server: server_option() = None
+):
     """Force stops the server"""
-    log_requests(interaction, f"force_stop_server")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"force_stop_server", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_lifecycle_command(
+            server, backend, "force_stop", backend.force_stop_server
+        ),
+        track_action="force_stop",
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.stop_server)
-    else:
-        command_msg = await run_server_command(aph.force_stop_server)
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
 
 
 @bot.command()
 async def run_console_command(
     interaction: discord.Interaction,
     command: discord.Option(str, "Command you want to run on the console"),
+    server: server_option() = None,
 ):
     """Run a command using the server console log"""
-    log_requests(interaction, f"run_console_command [command={command}]")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(interaction, f"run_console_command [command={command}]", server)
+    if not await check_request(interaction):
+        return
+    await run_backend_command(
+        interaction,
+        server,
+        lambda backend: run_server_command(
+            backend, backend.run_console_command, param=command
+        ),
     )
-    if USE_NITRADO:
-        command_msg = await run_server_command(napi.run_console_command, param=command)
-    else:
-        command_msg = await run_server_command(aph.run_console_command, param=command)
-    if command_msg is not None:
-        command_msg = f"```{command_msg}```"
-    else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
+
+
+@bot.command()
+async def run_console_script(
+    interaction: discord.Interaction,
+    script: discord.Option(
+        str,
+        "A macro name, or commands separated by ';'. Use 'wait <seconds>' to pause",
+    ),
+    server: server_option() = None,
+):
+    """Run several console commands in one go"""
+    log_requests(interaction, f"run_console_script [script={script}]", server)
+    if not await check_request(interaction):
+        return
+    try:
+        steps = parse_console_script(script, console_macros)
+    except ValueError as err:
+        await reply(interaction, f"```{err}```")
+        return
+
+    async def run_script(backend):
+        async def run_steps(script_steps):
+            return format_script_results(await backend.run_console_script(script_steps))
+
+        return await run_server_command(backend, run_steps, param=steps, max_tries=1)
+
+    await run_backend_command(interaction, server, run_script)
 
 
 # To make an argument optional, you can either give it a supported default argument
@@ -226,109 +480,368 @@ async def get_console_log(
         max_value=20,
         default=10,
     ),
+    search: discord.Option(
+        str, "Only return lines containing this text", default=None
+    ),
+    server: server_option() = None,
 ):
     """Returns last messages from console logs. Defaults to 10"""
-    log_requests(interaction, f"get_console_log [lines={lines}]")
-    await check_request(interaction)
-    await interaction.response.send_message(
-        f"```{FIRST_RESPONSE_MESSAGE}```", ephemeral=False
+    log_requests(
+        interaction, f"get_console_log [lines={lines}, search={search}]", server
+    )
+    if not await check_request(interaction):
+        return
+
+    async def get_log(backend):
+        async def read_log(log_lines):
+            return await backend.get_console_log(log_lines, search)
+
+        return await run_server_command(backend, read_log, param=lines)
+
+    def format_log(command_msg):
+        if len(command_msg) > MAX_MESSAGE_LENGTH:
+            command_msg = "..." + command_msg[-MAX_MESSAGE_LENGTH:]
+        title = f"Last {lines} lines" + (f" matching '{search}'" if search else "")
+        return f"## Console Log\n{title}\n```{command_msg}```"
+
+    await run_backend_command(interaction, server, get_log, format_result=format_log)
+
+
+@bot.command()
+async def all_server_status(interaction: discord.Interaction):
+    """Gets the status of every server"""
+    log_requests(interaction, f"all_server_status")
+    if not await check_request(interaction):
+        return
+    await run_command(interaction, lambda: run_on_all_servers("get_server_status"))
+
+
+@bot.command()
+async def start_all_servers(interaction: discord.Interaction):
+    """Starts every server"""
+    log_requests(interaction, f"start_all_servers")
+    if not await check_request(interaction):
+        return
+    await run_command(
+        interaction, lambda: run_on_all_servers("safe_start_server", action="start")
+    )
+
+
+@bot.command()
+async def stop_all_servers(interaction: discord.Interaction):
+    """Stops every server"""
+    log_requests(interaction, f"stop_all_servers")
+    if not await check_request(interaction):
+        return
+    await run_command(
+        interaction, lambda: run_on_all_servers("safe_stop_server", action="stop")
+    )
+
+
+@bot.command()
+async def broadcast_all_servers(
+    interaction: discord.Interaction,
+    message: discord.Option(str, "The message to show in game on every server"),
+):
+    """Broadcasts a message on every server"""
+    log_requests(interaction, f"broadcast_all_servers [message={message}]")
+    if not await check_request(interaction):
+        return
+    await run_command(
+        interaction, lambda: run_on_all_servers("broadcast", param=message)
+    )
+
+
+def log_requests(interaction: discord.Interaction, command: str, server=None):
+    user = interaction.user
+    server = server or registry.default_name
+    # Arguments are only formatted if the record is actually written.
+    logging.info(
+        "Username: %s | User ID: %s | Channel: %s | Server: %s | Request: %s",
+        user.name,
+        user.id,
+        interaction.channel,
+        server,
+        command,
+        extra={"command": command, "user_id": user.id, "server": server},
     )
-    if USE_NITRADO:
-        command_msg = "Command not yet supported for this server"
+
+
+async def reply(interaction: discord.Interaction, content):
+    with SEND_SECONDS.time():
+        if interaction.response.is_done():
+            await interaction.edit(content=content)
+        else:
+            await interaction.response.send_message(content)
+
+
+async def run_command(interaction: discord.Interaction, call, format_result=None):
+    # Quick answers go out as the first response; anything slower is deferred and
+    # then edited in place, so every command is one message in the channel.
+    task = asyncio.ensure_future(call())
+    done, _ = await asyncio.wait({task}, timeout=DEFER_AFTER)
+    if not done:
+        await interaction.defer()
+    try:
+        command_msg = await task
+    except Exception as err:
+        logging.exception("Command failed: %s", err)
+        command_msg = None
+    if command_msg is None:
+        await reply(interaction, f"```{ERROR_MESSAGE}```")
+    elif format_result is not None:
+        await reply(interaction, format_result(command_msg))
     else:
-        command_msg = await run_server_command(aph.run_console_command, param=lines)
-    if command_msg is not None:
-        command_msg = f"## Console Log\nLast {lines} lines\n```{command_msg}```"
+        await reply(interaction, f"```{command_msg}```")
+    return command_msg
+
+
+async def run_backend_command(
+    interaction: discord.Interaction,
+    server,
+    call,
+    format_result=None,
+    track_action=None,
+):
+    if registry.resolve_name(server) is None:
+        await reply(interaction, f"```Unknown server: {server}```")
+        return
+    # The backend is looked up inside the call so starting it counts towards the defer.
+    command_msg = await run_command(
+        interaction, lambda: call(registry.get(server)), format_result
+    )
+    if command_msg is not None and track_action is not None:
+        await track_server_command(
+            interaction, server, registry.get(server), track_action, command_msg
+        )
+
+
+async def run_on_all_servers(method_name, param=None, action=None):
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def run_on_server(name, backend):
+        func = getattr(backend, method_name)
+        async with semaphore:
+            if action is not None:
+                return await run_lifecycle_command(name, backend, action, func)
+            return await run_server_command(backend, func, param=param)
+
+    servers = registry.items()
+    results = await asyncio.gather(
+        *[run_on_server(name, backend) for name, backend in servers]
+    )
+    return "\n".join(
+        f"{name}: {result if result is not None else ERROR_MESSAGE}"
+        for (name, _), result in zip(servers, results)
+    )
+
+
+def format_script_results(results):
+    lines = []
+    for command, response in results:
+        lines.append(f"> {command}")
+        if response:
+            lines.append(response.strip())
+    message = "\n".join(lines)
+    if len(message) > MAX_MESSAGE_LENGTH:
+        message = message[: MAX_MESSAGE_LENGTH - 3] + "..."
+    return message
+
+
+def start_dashboard():
+    global dashboard
+    if dashboard is not None:
+        return
+    channel = discord.utils.get(bot.get_all_channels(), name=CHANNEL_NAME)
+    if not isinstance(channel, discord.TextChannel):
+        logging.error(f"Dashboard channel {CHANNEL_NAME} not found")
+        return
+    dashboard = StatusDashboard(
+        [
+            (name, backend.get_server_status, backend.transitional_statuses)
+            for name, backend in registry.items()
+        ],
+        format_time,
+        fast_interval=int(os.getenv("DASHBOARD_FAST_INTERVAL", 10)),
+        slow_interval=int(os.getenv("DASHBOARD_SLOW_INTERVAL", 120)),
+    )
+    dashboard.start(channel)
+
+
+async def track_server_command(
+    interaction: discord.Interaction, server, backend, action, command_msg
+):
+    if not command_issued(command_msg):
+        return
+    tracker = actors[registry.resolve_name(server)].trackers.get(action)
+    if tracker is None:
+        return
+
+    async def on_progress(seen, elapsed):
+        progress = " → ".join(seen)
+        await reply(interaction, f"```{command_msg}\n{progress} ({elapsed:.0f} s)```")
+
+    status, elapsed, seen = await tracker.follow(on_progress)
+    progress = " → ".join(seen)
+    if transition_reached(backend, action, status):
+        content = f"{progress} in {elapsed:.0f} s"
     else:
-        command_msg = f"```{ERROR_MESSAGE}```"
-    await interaction.channel.send(command_msg)
+        content = f"{progress}: gave up waiting after {elapsed:.0f} s"
+    await reply(interaction, f"```{command_msg}\n{content}```")
 
 
-def log_requests(interaction: discord.Interaction, command: str):
-    user = interaction.user
-    channel = interaction.channel
+def command_issued(command_msg):
+    # Backends answer a command they turned down with "Cannot ...".
+    return command_msg is not None and not command_msg.startswith("Cannot ")
+
+
+def transition_reached(backend, action, status):
+    action = TRANSITIONS.get(action, action)
+    targets = [target.lower() for target in backend.action_targets[action]]
+    return status is not None and status.lower() in targets
+
+
+async def wait_for_transition(backend, action, on_progress):
+    action = TRANSITIONS.get(action, action)
+    status, elapsed, seen = await backend.wait_for_status(
+        backend.action_targets[action],
+        timeout=STATUS_WAIT_TIMEOUT,
+        on_progress=on_progress,
+        require_change=action == "restart",
+    )
+    if transition_reached(backend, action, status):
+        backend.transition_stats.record(action, elapsed)
+    return status, elapsed, seen
+
+
+def format_time(timestamp):
+    run_time = datetime.fromtimestamp(timestamp, pytz.timezone("US/Central"))
+    return run_time.strftime("%I:%M %p")
+
+
+def schedule_server_action(action, minutes, interaction: discord.Interaction, server):
+    server = registry.resolve_name(server)
+    if server is None:
+        return f"Unknown server"
+    job, created = scheduler.schedule(
+        action, minutes, interaction.channel.id, interaction.user.name, server
+    )
+    if not created:
+        return (
+            f"A {job.action} of {server} is already scheduled at: "
+            f"{format_time(job.run_at)} (#{job.job_id})"
+        )
     logging.info(
-        f"Username: {user.name} | Channel: {channel} | Roles: {user.roles} | Request: {command}"
+        f"Scheduled {action} of {server} #{job.job_id} at {format_time(job.run_at)}"
+    )
+    return (
+        f"Server {server} {action} scheduled at: {format_time(job.run_at)} "
+        f"(#{job.job_id})"
     )
 
 
+async def run_scheduled_job(job):
+    backend = registry.get(job.server)
+    if backend is None:
+        logging.error(f"Scheduled job {job.job_id} is for unknown server {job.server}")
+        return
+    func = getattr(backend, SCHEDULED_ACTIONS[job.action])
+    command_msg = await run_lifecycle_command(job.server, backend, job.action, func)
+    if command_msg is None:
+        command_msg = ERROR_MESSAGE
+    channel = bot.get_channel(job.channel_id)
+    if channel is not None:
+        await send_message(channel, f"```Scheduled {job.action} #{job.job_id}: {command_msg}```")
+
+
+async def warn_scheduled_job(job, minutes):
+    channel = bot.get_channel(job.channel_id)
+    if channel is not None:
+        await send_message(
+            channel,
+            f"```Server {job.server or registry.default_name} {job.action} "
+            f"in {minutes} minute(s)!```",
+        )
+
+
 async def run_server_command(
-    func, interaction: discord.Interaction = None, minutes=0, param=None
+    backend,
+    func,
+    param=None,
+    max_tries=MAX_RETRIES,
 ):
     command_msg = None
+    outcome = "error"
+    start = time.monotonic()
     try:
-        if minutes >= 0 and interaction is not None:
-            stop_time = datetime.now(pytz.timezone("US/Central")) + timedelta(
-                minutes=minutes
-            )
-            stop_time_str = stop_time.strftime("%I:%M %p")
-            logging.info(
-                f"Starting sleep for {minutes} min! Stop time: {stop_time_str}"
-            )
-            await interaction.channel.send(f"```Stopping sever at: {stop_time_str}```")
-            await asyncio.sleep(60 * minutes)
-        if not USE_NITRADO:
-            await retry_async(aph.login, max_tries=MAX_RETRIES)
-        result = await retry_async(func, param=param, max_tries=MAX_RETRIES)
+        result = await retry_async(
+            func, param=param, max_tries=max_tries, breaker=backend.circuit_breaker
+        )
         if result is not None:
             command_msg = f"{result}"
         else:
             command_msg = f"Command Sent Successfully!"
+        outcome = "ok"
     except Exception as err:
         logging.error(err)
+    BACKEND_SECONDS.observe(
+        time.monotonic() - start,
+        backend=type(backend).__name__,
+        call=getattr(func, "__name__", "call"),
+        outcome=outcome,
+    )
     logging.info(f"Command result message: {command_msg}")
     return command_msg
 
 
+async def run_lifecycle_command(server, backend, action, func):
+    name = registry.resolve_name(server)
+    if name not in actors:
+        actors[name] = CommandActor(name)
+    try:
+        return await actors[name].submit(
+            action,
+            lambda: run_server_command(backend, func),
+            follow=lambda on_progress: wait_for_transition(
+                backend, action, on_progress
+            ),
+            follow_if=command_issued,
+        )
+    except CommandRejected as err:
+        logging.info(err)
+        return f"{err}"
+
+
 async def check_request(interaction: discord.Interaction):
     channel = interaction.channel
     if CHANNEL_NAME is not None and channel.name != CHANNEL_NAME:
         await interaction.response.send_message(
-            f"This is the wrong channel!", ephemeral=False
+            f"This is the wrong channel!", ephemeral=True
         )
-        return
+        return False
+    command = interaction.command.qualified_name
+    if not permissions.is_allowed(command, interaction.guild_id, interaction.user):
+        logging.info(
+            "Denied %s to %s", command, interaction.user.id, extra={"command": command}
+        )
+        await interaction.response.send_message(
+            f"You do not have permission to use this command!", ephemeral=True
+        )
+        return False
+    return True
 
 
-def retry(func, param=None, max_tries=2):
-    count = 0
-    result = ""
-    while count < max_tries:
-        try:
-            if param is not None:
-                result = func(param)
-            else:
-                result = func()
-        except Exception as e:
-            count += 1
-            if count >= max_tries:
-                logging.info(f"Max retries reached: {func}")
-                raise
-            time.sleep(2)
-            logging.error("Exception occurred: %s", e)
-            logging.info(f"Retrying Last Function call: {func}")
-            continue
-        return result
-
-
-async def retry_async(func, param=None, max_tries=2):
-    count = 0
-    result = ""
-    while count < max_tries:
-        try:
-            if param is not None:
-                result = await func(param)
-            else:
-                result = await func()
-        except Exception as e:
-            count += 1
-            if count >= max_tries:
-                logging.info(f"Max retries reached: {func}")
-                raise
-            time.sleep(2)
-            logging.exception("Exception occurred: %s", e)
-            logging.info(f"Retrying Last Function call: {func}")
-            continue
-        return result
-
-
-bot.run(DISCORD_TOKEN)
+def retry(func, param=None, max_tries=2, breaker=None):
+    args = (param,) if param is not None else ()
+    return retry_policy.run(func, *args, max_tries=max_tries, breaker=breaker)
+
+
+async def retry_async(func, param=None, max_tries=2, breaker=None):
+    args = (param,) if param is not None else ()
+    return await retry_policy.run_async(
+        func, *args, max_tries=max_tries, breaker=breaker
+    )
+
+
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)
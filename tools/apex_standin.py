@@ -0,0 +1,123 @@
+import argparse
+import html
+import os
+import time
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "apex")
+SESSION_COOKIE = "PHPSESSID"
+SESSION_ID = "standin-session"
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as fixture:
+        return fixture.read()
+
+
+class ApexStandIn:
+    def __init__(self, server_id="12345", username="admin", password="admin"):
+        self.server_id = server_id
+        self.username = username
+        self.password = password
+        self.status = "offline"
+        self.log = []
+        self.add_log("Server stand-in ready")
+
+    def add_log(self, line):
+        self.log.append(time.strftime("%d.%m %H:%M:%S ") + line)
+
+    def logged_in(self, request):
+        return request.cookies.get(SESSION_COOKIE) == SESSION_ID
+
+    def render(self, name, **values):
+        page = load_fixture(name)
+        for key, value in values.items():
+            page = page.replace("{" + key + "}", value)
+        return web.Response(text=page, content_type="text/html")
+
+    def render_login(self, error=""):
+        return self.render("login.html", error=error)
+
+    def render_console(self):
+        # Like the real panel, the status and log are only filled in by the page's script.
+        running = self.status == "online"
+        return self.render(
+            "console.html",
+            start_disabled='disabled="disabled"' if running else "",
+            stop_disabled="" if running else 'disabled="disabled"',
+        )
+
+    def render_fragment(self, form):
+        if form.get("ajax") == "get_status":
+            icon = load_fixture("statusicon.html").replace("{status}", self.status)
+            return web.json_response({"statusicon": icon.strip()})
+        if form.get("ajax") == "refresh":
+            # log_seq counts the lines sent so far, only newer ones are sent back.
+            log_seq = int(form.get("log_seq") or 0)
+            lines = self.log[min(log_seq, len(self.log)):][-200:]
+            log = "".join(html.escape(line) + "<br/>" for line in lines)
+            return web.json_response({"log": log, "log_seq": str(len(self.log))})
+        return web.json_response({})
+
+    async def index(self, request):
+        if not self.logged_in(request):
+            return self.render_login()
+        return self.render("index.html", server_id=self.server_id)
+
+    async def login(self, request):
+        form = await request.post()
+        if (
+            form.get("LoginForm[name]") != self.username
+            or form.get("LoginForm[password]") != self.password
+        ):
+            return self.render_login(
+                '<div class="errorMessage">Incorrect username or password.</div>'
+            )
+        response = web.HTTPFound("/")
+        response.set_cookie(SESSION_COOKIE, SESSION_ID)
+        raise response
+
+    async def console(self, request):
+        if not self.logged_in(request):
+            return self.render_login()
+        return self.render_console()
+
+    async def console_action(self, request):
+        if not self.logged_in(request):
+            return self.render_login()
+        form = await request.post()
+        if "ajax" in form:
+            return self.render_fragment(form)
+        if "yt0" in form:
+            self.status = "online"
+            self.add_log("Server started")
+        elif "yt1" in form or "yt3" in form:
+            self.status = "offline"
+            self.add_log("Server stopped")
+        elif "yt2" in form:
+            self.add_log("Server restarted")
+        elif "yt4" in form:
+            self.add_log("Console command: " + form.get("command", ""))
+        return self.render_console()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_post("/", self.login)
+        app.router.add_get("/server/{server_id}", self.console)
+        app.router.add_get("/server/log/{server_id}", self.console)
+        app.router.add_post("/server/{server_id}", self.console_action)
+        app.router.add_post("/server/log/{server_id}", self.console_action)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve saved Apex panel pages locally. "
+        "Point APH_PANEL_URL at http://localhost:<port>/ to use it."
+    )
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--server-id", default="12345")
+    args = parser.parse_args()
+    web.run_app(ApexStandIn(server_id=args.server_id).make_app(), port=args.port)
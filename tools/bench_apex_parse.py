@@ -0,0 +1,106 @@
+import argparse
+import html
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ApexPageParser import PARSER, parse_panel_page  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "apex")
+# Stands in for the menus, scripts and widgets around the parts the bot reads.
+PANEL_CHROME = (
+    '<div class="sidebar"><ul>'
+    + "".join(f'<li class="menu-item"><a href="/page/{i}">Menu {i}</a></li>' for i in range(40))
+    + "</ul></div>"
+)
+
+
+def load_fixture(name, **values):
+    with open(os.path.join(FIXTURES_DIR, name)) as fixture:
+        page = fixture.read()
+    for key, value in values.items():
+        page = page.replace("{" + key + "}", value)
+    return page
+
+
+def render_log(log_lines):
+    return "".join(
+        html.escape(f"18.10 12:{i // 60 % 60:02d}:{i % 60:02d} Player joined: {i}")
+        + "<br/>"
+        for i in range(log_lines)
+    )
+
+
+def load_page(name, padding, **values):
+    page = load_fixture(name, **values)
+    return page.replace("<body>", "<body>" + PANEL_CHROME * padding, 1)
+
+
+def load_rendered_console(log_lines, padding, status):
+    # The console as the browser has it once the page's script filled in the fragments.
+    page = load_page(
+        "console.html",
+        padding,
+        start_disabled='disabled="disabled"',
+        stop_disabled="",
+    )
+    status_icon = load_fixture("statusicon.html", status=status).strip()
+    page = page.replace(
+        '<div id="statusicon-ajax"></div>',
+        f'<div id="statusicon-ajax">{status_icon}</div>',
+    )
+    return page.replace(
+        '<div id="log-ajax"></div>', f'<div id="log-ajax">{render_log(log_lines)}</div>'
+    )
+
+
+def parse_full(page_source):
+    # What the scraper did before: a full html.parser tree, searched once per field.
+    soup = BeautifulSoup(page_source, features="html.parser")
+    status_icon = soup.find("div", id="statusicon-ajax")
+    console_log = soup.find("div", id="log-ajax")
+    return (
+        status_icon.img.attrs["src"] if status_icon is not None else None,
+        console_log.text if console_log is not None else None,
+        soup.find("li", id="logout_link") is not None,
+        soup.find("div", class_="errorMessage") is not None,
+    )
+
+
+def time_parser(parse, page_source, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(page_source)
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare full-page parsing with the targeted Apex page parser "
+        "over the saved panel fixtures."
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--log-lines", type=int, default=200)
+    parser.add_argument(
+        "--padding", type=int, default=10, help="Blocks of menu markup added to each page"
+    )
+    args = parser.parse_args()
+
+    pages = {
+        "console": load_rendered_console(args.log_lines, args.padding, "online"),
+        "index": load_page("index.html", args.padding, server_id="12345"),
+        "login": load_page("login.html", args.padding, error=""),
+    }
+    print(f"Targeted parser uses {PARSER}")
+    print(f"{'page':<10}{'size KiB':>10}{'full ms':>10}{'targeted ms':>13}{'speedup':>9}")
+    for name, page_source in pages.items():
+        full = time_parser(parse_full, page_source, args.iterations)
+        targeted = time_parser(parse_panel_page, page_source, args.iterations)
+        print(
+            f"{name:<10}{len(page_source) / 1024:>10.1f}{full * 1000:>10.2f}"
+            f"{targeted * 1000:>13.2f}{full / targeted:>8.1f}x"
+        )
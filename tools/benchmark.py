@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from nitrado_standin import NitradoStandIn
+from rcon_standin import RconStandIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RCON_PASSWORD = "password"
+interaction_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"bench-user-{user_id}"
+        self.roles = []
+
+
+class FakeChannel:
+    def __init__(self, send_latency):
+        self.id = 1
+        self.name = "bench"
+        self.send_latency = send_latency
+        self.sent = 0
+
+    async def send(self, content):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+
+
+class FakeCommand:
+    def __init__(self, name):
+        self.qualified_name = name
+
+
+class FakeResponse:
+    def __init__(self, channel):
+        self.channel = channel
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def send_message(self, content, ephemeral=False):
+        self.done = True
+        await self.channel.send(content)
+
+    async def defer(self):
+        self.done = True
+        await self.channel.send(None)
+
+
+class FakeInteraction:
+    # Just enough of discord.ApplicationContext for the command handlers in main.py.
+    def __init__(self, channel, command):
+        self.id = next(interaction_ids)
+        self.user = FakeUser(self.id % 5)
+        self.channel = channel
+        self.guild_id = None
+        self.command = FakeCommand(command)
+        self.response = FakeResponse(channel)
+
+    async def defer(self):
+        await self.response.defer()
+
+    async def edit(self, content):
+        await self.channel.send(content)
+
+
+class LagMonitor:
+    def __init__(self, interval=0.005, threshold=0.01):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0, time.monotonic() - start - self.interval))
+
+    def start(self):
+        self.lags = []
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self.task.cancel()
+        blocked = sum(lag for lag in self.lags if lag > self.threshold)
+        return max(self.lags, default=0), blocked
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def configure_environment(args, api_port, rcon_port, work_dir):
+    # Must happen before main is imported, it reads its settings at import time.
+    os.environ.update(
+        {
+            "NITRADO_API_URL": f"http://127.0.0.1:{api_port}",
+            "NITRADO_TOKEN": "bench-token",
+            "SERVER_ID": "1",
+            "RCON_IP_FULL": f"127.0.0.1:{rcon_port}",
+            "RCON_PWD": RCON_PASSWORD,
+            "NITRADO_LOG_FILE": "ShooterGame.log",
+            "NITRADO_RATE_LIMIT": str(args.rate_limit),
+            "NITRADO_RATE_BURST": str(args.rate_burst),
+            "MAX_RETRIES": str(args.max_retries),
+            "RETRY_BASE_DELAY": "0.1",
+            "LOG_LEVEL": "WARNING",
+            "NITRADO_LOG_LEVEL": "WARNING",
+            "LOG_FILE": os.path.join(work_dir, "discord.log"),
+            "SCHEDULER_DB": os.path.join(work_dir, "scheduler.db"),
+            "SERVERS_FILE": os.path.join(work_dir, "servers.json"),
+            "STATUS_WAIT_TIMEOUT": str(args.wait_timeout),
+            "METRICS_ENABLED": "false",
+        }
+    )
+    for name in ("CHANNEL_NAME", "ROLE_NAME", "COMMAND_ROLES"):
+        os.environ.pop(name, None)
+
+
+def build_scenarios(main):
+    backend = main.registry.get()
+    return {
+        "run_server_command": lambda interaction: main.run_server_command(
+            backend, backend.fetch_server_status
+        ),
+        "get_server_status": lambda interaction: main.get_server_status.callback(
+            interaction, None
+        ),
+        "run_console_command": lambda interaction: main.run_console_command.callback(
+            interaction, "ListPlayers", None
+        ),
+        "get_console_log": lambda interaction: main.get_console_log.callback(
+            interaction, 10, None, None
+        ),
+        "restart_server": lambda interaction: main.restart_server.callback(
+            interaction, None
+        ),
+    }
+
+
+async def run_scenario(name, scenario, args, channel):
+    latencies = []
+    errors = 0
+    remaining = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.monotonic()
+            try:
+                await scenario(FakeInteraction(channel, name))
+            except Exception as err:
+                errors += 1
+                print(f"{name} failed: {err!r}")
+            latencies.append(time.monotonic() - start)
+
+    monitor = LagMonitor()
+    monitor.start()
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.monotonic() - start
+    max_lag, blocked = monitor.stop()
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max_lag": max_lag,
+        "blocked": blocked,
+    }
+
+
+def print_results(results):
+    header = (
+        f"{'scenario':<22}{'reqs':>6}{'errs':>6}{'req/s':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max lag ms':>12}{'blocked ms':>12}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['name']:<22}{result['requests']:>6}{result['errors']:>6}"
+            f"{result['throughput']:>9.1f}{result['p50'] * 1000:>9.1f}"
+            f"{result['p95'] * 1000:>9.1f}{result['p99'] * 1000:>9.1f}"
+            f"{result['max_lag'] * 1000:>12.1f}{result['blocked'] * 1000:>12.1f}"
+        )
+
+
+async def run_benchmark(args):
+    nitrado = NitradoStandIn(
+        latency=args.api_latency,
+        error_rate=args.error_rate,
+        rate_limited_rate=args.rate_limited_rate,
+        transition_time=args.transition_time,
+    )
+    runner = web.AppRunner(nitrado.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    api_port = runner.addresses[0][1]
+    rcon = RconStandIn(password=RCON_PASSWORD, latency=args.rcon_latency)
+    rcon_port = await rcon.start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        configure_environment(args, api_port, rcon_port, work_dir)
+        import main
+
+        scenarios = build_scenarios(main)
+        channel = FakeChannel(args.send_latency)
+        results = []
+        try:
+            for name in args.scenarios:
+                results.append(await run_scenario(name, scenarios[name], args, channel))
+        finally:
+            await main.registry.close()
+            await rcon.stop()
+            await runner.cleanup()
+    print_results(results)
+    print(
+        f"\nFake Nitrado saw {nitrado.requests} requests, "
+        f"fake RCON ran {rcon.commands} commands, "
+        f"{channel.sent} Discord API writes were made"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the bot's command handlers against local "
+        "Nitrado and RCON stand-ins."
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=[
+            "run_server_command",
+            "get_server_status",
+            "run_console_command",
+            "get_console_log",
+        ],
+        help="Any of run_server_command, get_server_status, run_console_command, "
+        "get_console_log, restart_server",
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--rcon-latency", type=float, default=0.01)
+    parser.add_argument("--send-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limited-rate", type=float, default=0.0)
+    parser.add_argument("--transition-time", type=float, default=1.0)
+    parser.add_argument("--wait-timeout", type=int, default=30)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--rate-limit", type=int, default=1000000)
+    parser.add_argument("--rate-burst", type=int, default=1000)
+    asyncio.run(run_benchmark(parser.parse_args()))
@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+LOG_PATH = "/files/ShooterGame.log"
+
+
+class NitradoStandIn:
+    def __init__(
+        self,
+        latency=0.05,
+        error_rate=0.0,
+        rate_limited_rate=0.0,
+        transition_time=1.0,
+        rate_limit=100000,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limited_rate = rate_limited_rate
+        self.transition_time = transition_time
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.reset_at = time.time() + 3600
+        self.status = "stopped"
+        self.target = None
+        self.log = bytearray()
+        self.requests = 0
+        self.add_log("Server stand-in ready")
+
+    def add_log(self, line):
+        self.log += (time.strftime("%Y.%m.%d-%H.%M.%S: ") + line + "\n").encode()
+
+    def transition(self, status, target):
+        self.status = status
+        self.target = target
+        self.add_log(f"Server {status}")
+        asyncio.get_running_loop().call_later(self.transition_time, self.finish)
+
+    def finish(self):
+        if self.target is not None:
+            self.status, self.target = self.target, None
+            self.add_log(f"Server {self.status}")
+
+    def rate_limit_headers(self):
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(max(0, self.remaining)),
+            "X-RateLimit-Reset": str(int(self.reset_at)),
+        }
+
+    @web.middleware
+    async def simulate(self, request, handler):
+        self.requests += 1
+        await asyncio.sleep(random.uniform(self.latency / 2, self.latency * 1.5))
+        if request.path.startswith("/files/"):
+            return await handler(request)
+        self.remaining -= 1
+        headers = self.rate_limit_headers()
+        if self.remaining < 0 or random.random() < self.rate_limited_rate:
+            headers["Retry-After"] = "1"
+            return web.json_response(
+                {"status": "error", "message": "Rate limit exceeded"},
+                status=429,
+                headers=headers,
+            )
+        if random.random() < self.error_rate:
+            return web.json_response(
+                {"status": "error", "message": "Internal error"},
+                status=500,
+                headers=headers,
+            )
+        response = await handler(request)
+        response.headers.update(headers)
+        return response
+
+    def message(self, message):
+        return web.json_response({"status": "success", "message": message})
+
+    async def gameserver(self, request):
+        return web.json_response(
+            {"status": "success", "data": {"gameserver": {"status": self.status}}}
+        )
+
+    async def stop(self, request):
+        self.transition("stopping", "stopped")
+        return self.message("Server will be stopped now.")
+
+    async def start(self, request):
+        self.transition("restarting", "started")
+        return self.message("Server will be started now.")
+
+    async def restart(self, request):
+        self.transition("restarting", "started")
+        return self.message("Server will be restarted now.")
+
+    async def uninstall(self, request):
+        return self.message("Game uninstalled.")
+
+    async def download(self, request):
+        url = f"{request.scheme}://{request.host}{LOG_PATH}"
+        return web.json_response(
+            {"status": "success", "data": {"token": {"url": url, "token": "standin"}}}
+        )
+
+    async def log_file(self, request):
+        size = len(self.log)
+        byte_range = request.headers.get("Range", "")
+        if not byte_range.startswith("bytes="):
+            return web.Response(body=bytes(self.log))
+        first, _, last = byte_range[len("bytes=") :].partition("-")
+        if first == "":
+            start = max(0, size - int(last))
+        else:
+            start = int(first)
+        if start >= size:
+            return web.Response(
+                status=416, headers={"Content-Range": f"bytes */{size}"}
+            )
+        return web.Response(
+            status=206,
+            body=bytes(self.log[start:]),
+            headers={"Content-Range": f"bytes {start}-{size - 1}/{size}"},
+        )
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.simulate])
+        base = "/services/{service_id}/gameservers"
+        app.router.add_get(base, self.gameserver)
+        app.router.add_post(base + "/stop", self.stop)
+        app.router.add_post(base + "/games/start", self.start)
+        app.router.add_post(base + "/restart", self.restart)
+        app.router.add_delete(base + "/games/uninstall", self.uninstall)
+        app.router.add_get(base + "/file_server/download", self.download)
+        app.router.add_get(LOG_PATH, self.log_file)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a fake Nitrado gameserver API locally. "
+        "Point NITRADO_API_URL at http://localhost:<port> to use it."
+    )
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limited-rate", type=float, default=0.0)
+    parser.add_argument("--transition-time", type=float, default=5.0)
+    args = parser.parse_args()
+    standin = NitradoStandIn(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limited_rate=args.rate_limited_rate,
+        transition_time=args.transition_time,
+    )
+    web.run_app(standin.make_app(), port=args.port)
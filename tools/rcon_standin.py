@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import random
+import struct
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+MAX_BODY_SIZE = 4096
+
+
+class RconStandIn:
+    def __init__(self, password="password", latency=0.01, response_size=0):
+        self.password = password
+        self.latency = latency
+        # Pads responses so they are split over several packets like long real ones.
+        self.response_size = response_size
+        self.commands = 0
+        self.server = None
+
+    def packet(self, packet_id, packet_type, body):
+        payload = struct.pack("<ii", packet_id, packet_type) + body.encode() + b"\x00\x00"
+        return struct.pack("<i", len(payload)) + payload
+
+    async def reply(self, writer, packet_id, command, previous):
+        await asyncio.sleep(random.uniform(self.latency / 2, self.latency * 1.5))
+        # Real servers work through a connection's commands in order.
+        if previous is not None:
+            await previous
+        self.commands += 1
+        if not writer.is_closing():
+            response = f"Server received, But no response!! ({command})"
+            response = response.ljust(self.response_size, ".")
+            for start in range(0, len(response), MAX_BODY_SIZE):
+                writer.write(
+                    self.packet(
+                        packet_id,
+                        SERVERDATA_RESPONSE_VALUE,
+                        response[start : start + MAX_BODY_SIZE],
+                    )
+                )
+
+    async def mirror(self, writer, packet_id, previous):
+        if previous is not None:
+            await previous
+        if not writer.is_closing():
+            # What Source servers send back for an empty response value packet.
+            writer.write(self.packet(packet_id, SERVERDATA_RESPONSE_VALUE, ""))
+            writer.write(
+                self.packet(packet_id, SERVERDATA_RESPONSE_VALUE, "\x00\x00\x00\x01")
+            )
+
+    async def handle(self, reader, writer):
+        authenticated = False
+        previous = None
+        try:
+            while True:
+                size = struct.unpack("<i", await reader.readexactly(4))[0]
+                data = await reader.readexactly(size)
+                packet_id, packet_type = struct.unpack("<ii", data[:8])
+                body = data[8:-2].decode(errors="replace")
+                if packet_type == SERVERDATA_AUTH:
+                    authenticated = body == self.password
+                    # Real servers send an empty response value ahead of the auth result.
+                    writer.write(self.packet(packet_id, SERVERDATA_RESPONSE_VALUE, ""))
+                    writer.write(
+                        self.packet(
+                            packet_id if authenticated else -1,
+                            SERVERDATA_AUTH_RESPONSE,
+                            "",
+                        )
+                    )
+                elif packet_type == SERVERDATA_EXECCOMMAND and authenticated:
+                    previous = asyncio.ensure_future(
+                        self.reply(writer, packet_id, body, previous)
+                    )
+                elif packet_type == SERVERDATA_RESPONSE_VALUE and authenticated:
+                    previous = asyncio.ensure_future(
+                        self.mirror(writer, packet_id, previous)
+                    )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+async def serve(args):
+    standin = RconStandIn(
+        password=args.password,
+        latency=args.latency,
+        response_size=args.response_size,
+    )
+    port = await standin.start(port=args.port)
+    print(f"RCON stand-in listening on 127.0.0.1:{port}")
+    await standin.server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake Source RCON server.")
+    parser.add_argument("--port", type=int, default=27020)
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--response-size", type=int, default=0)
+    asyncio.run(serve(parser.parse_args()))